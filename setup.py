@@ -1,6 +1,8 @@
 from setuptools import setup, find_packages
+from setuptools.command.build_py import build_py
 from codecs import open
 from os import path
+import sys
 
 here = path.abspath(path.dirname(__file__))
 
@@ -8,6 +10,17 @@ here = path.abspath(path.dirname(__file__))
 with open(path.join(here, 'README.rst'), encoding='utf-8') as f:
     long_description = f.read()
 
+
+class BuildPy(build_py):
+    """Leaves out the asyncio module on Pythons without async def."""
+
+    def find_package_modules(self, package, package_dir):
+        modules = build_py.find_package_modules(self, package, package_dir)
+        if sys.version_info < (3, 5):
+            modules = [module for module in modules if module[:2] != ('simpycity', 'aio')]
+        return modules
+
+
 setup(
     name='Simpycity',
     version='2.0.1',
@@ -22,6 +35,7 @@ setup(
         "psycopg2>=2.5"
     ],
     packages=find_packages(),
+    cmdclass={'build_py': BuildPy},
     test_suite='simpycity.test',
     license='LGPL',
     include_package_data=True,
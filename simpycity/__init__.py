@@ -37,3 +37,6 @@ class NotFoundError(InternalError):
 class CannotSave(InternalError):
     pass
 
+class PoolError(OperationalError):
+    pass
+
@@ -0,0 +1,266 @@
+"""
+asyncio support: requires Python 3.5 or later.
+
+An *AsyncHandle* is a pool of asynchronous psycopg2 connections. Queries
+called with it return awaitables instead of results::
+
+    handle = AsyncHandle()
+    config.handle_factory = handle.handle_factory
+
+    rows = await Function("get_rows", ['id'])(1)
+    row = await QuerySingle("some_table", ['id'])(1)
+
+Each query runs on whichever connection is free, in autocommit mode; use
+*AsyncHandle.transaction* to run several queries in one transaction.
+Composite types must be registered globally, through a regular
+*simpycity.handle.Handle*, as registering needs a synchronous connection.
+"""
+import asyncio
+import collections
+import psycopg2
+import psycopg2.extensions
+from simpycity import config as g_config, PoolError
+from simpycity.handle import Cursor, TypedCursor
+
+
+def d_out(text, *args):
+
+    if g_config.debug:
+        print(text % args if args else text)
+
+
+async def wait(conn):
+    """
+    Poll *conn* until its current operation completes, yielding to the event
+    loop while the socket isn't ready.
+    """
+    loop = asyncio.get_event_loop()
+    while True:
+        state = conn.poll()
+        if state == psycopg2.extensions.POLL_OK:
+            return
+        if state == psycopg2.extensions.POLL_READ:
+            add, remove = loop.add_reader, loop.remove_reader
+        elif state == psycopg2.extensions.POLL_WRITE:
+            add, remove = loop.add_writer, loop.remove_writer
+        else:
+            raise psycopg2.OperationalError("Unexpected poll state: %s" % state)
+
+        ready = loop.create_future()
+        fileno = conn.fileno()
+        add(fileno, lambda: ready.done() or ready.set_result(None))
+        try:
+            await ready
+        finally:
+            remove(fileno)
+
+
+async def execute(conn, query, vars=None, cursor_factory=None, callback=None):
+    """
+    Run *query* on the asynchronous connection *conn*.
+    A connection left busy by an error or cancellation is closed.
+
+    :return: psycopg2 cursor holding the result
+    """
+    cursor = conn.cursor(cursor_factory=cursor_factory or Cursor)
+    if callback:
+        cursor.callback = callback
+    try:
+        cursor.execute(query, vars)
+        await wait(conn)
+    except BaseException:
+        if conn.isexecuting():
+            conn.close()
+        raise
+    if isinstance(cursor, TypedCursor):
+        cursor.check_description()
+    return cursor
+
+
+class AsyncHandle(object):
+    """
+    A pool of up to *maxconn* asynchronous connections, opened as needed and
+    shared by all coroutines of one event loop.
+    """
+
+    is_async = True
+
+    def __init__(self, dsn=None, config=None, maxconn=10, timeout=None):
+        """
+        :param str dsn: Override config.dsn()
+        :param config: Override global config
+        :param int maxconn: maximum number of connections
+        :param float timeout: seconds to wait for a free connection before raising
+            *simpycity.PoolError*; ``None`` waits forever
+        """
+        if maxconn < 1:
+            raise ValueError("AsyncHandle needs maxconn >= 1")
+        self.config = config or g_config
+        self.dsn = dsn or self.config.dsn()
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.closed = False
+        self._idle = []
+        self._waiters = collections.deque()
+        # connections idle, in use or being opened
+        self._size = 0
+
+    async def __connect__(self):
+        conn = psycopg2.connect(self.dsn, async_=True)
+        try:
+            await wait(conn)
+        except BaseException:
+            conn.close()
+            raise
+        d_out("AsyncHandle.__connect__: connection PID is %s", conn.get_backend_pid())
+        return conn
+
+    async def acquire(self):
+        """
+        :return: a connection for the caller's exclusive use; give it back with *release*
+        :raise simpycity.PoolError: if the handle is closed, or *timeout* expires
+            while all connections are in use
+        """
+        while True:
+            if self.closed:
+                raise PoolError("AsyncHandle is closed.")
+            while self._idle:
+                conn = self._idle.pop()
+                if not conn.closed:
+                    return conn
+                self._size -= 1
+            if self._size < self.maxconn:
+                self._size += 1
+                try:
+                    return await self.__connect__()
+                except BaseException:
+                    self._size -= 1
+                    self.__wake__()
+                    raise
+
+            waiter = asyncio.get_event_loop().create_future()
+            self._waiters.append(waiter)
+            try:
+                await asyncio.wait_for(waiter, self.timeout)
+            except asyncio.TimeoutError:
+                raise PoolError("AsyncHandle exhausted: %s connections in use." % self._size)
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def release(self, conn):
+        """
+        Return a connection obtained from *acquire*.
+        A connection that is broken, or still in a transaction, is closed.
+        """
+        if self.closed or conn.closed or \
+                conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            if not conn.closed:
+                conn.close()
+            self._size -= 1
+        else:
+            self._idle.append(conn)
+        self.__wake__()
+
+    def __wake__(self):
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                return
+
+    async def execute(self, query, vars=None, cursor_factory=None, callback=None, result=None):
+        """
+        Run *query* on a free connection.
+
+        :param cursor_factory: Override default Cursor
+        :param function callback: see *simpycity.handle.Cursor*
+        :param function result: applied to the cursor before it is returned
+        :return: psycopg2 cursor
+        """
+        conn = await self.acquire()
+        try:
+            cursor = await execute(conn, query, vars, cursor_factory, callback)
+        finally:
+            self.release(conn)
+        return result(cursor) if result else cursor
+
+    def transaction(self):
+        """
+        :return: an asynchronous context manager holding one connection in a
+            transaction, committed on success and rolled back on error::
+
+                async with handle.transaction() as tx:
+                    await Function("update_row", ['id', 'value'])(1, 'x', options={'handle': tx})
+        """
+        return AsyncTransaction(self)
+
+    def handle_factory(self, *args, **kwargs):
+        """
+        Drop-in replacement for *simpycity.config.handle_factory*.
+        Arguments are ignored: every caller shares this handle.
+
+        :return: this handle
+        """
+        return self
+
+    def close(self):
+        """
+        Close idle connections and refuse further queries. Connections still
+        in use are closed when they are released.
+        """
+        self.closed = True
+        while self._idle:
+            self._idle.pop().close()
+            self._size -= 1
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+
+    @property
+    def size(self):
+        """Number of connections currently open, idle or in use."""
+        return self._size
+
+    def __repr__(self):
+        return "<AsyncHandle: %s/%s connections>" % (self._size, self.maxconn)
+
+
+class AsyncTransaction(object):
+    """
+    One connection of an *AsyncHandle*, in a transaction for the duration of
+    an ``async with`` block. Pass it as the handle of the queries to run in it.
+    """
+
+    is_async = True
+
+    def __init__(self, handle):
+        self.handle = handle
+        self.conn = None
+
+    async def __aenter__(self):
+        self.conn = await self.handle.acquire()
+        try:
+            await execute(self.conn, "BEGIN")
+        except BaseException:
+            self.handle.release(self.conn)
+            raise
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        conn, self.conn = self.conn, None
+        try:
+            if not conn.closed:
+                await execute(conn, "ROLLBACK" if exc_type else "COMMIT")
+        finally:
+            self.handle.release(conn)
+
+    async def execute(self, query, vars=None, cursor_factory=None, callback=None, result=None):
+        """
+        As *AsyncHandle.execute*, on the transaction's connection.
+        """
+        if self.conn is None:
+            raise PoolError("Transaction is not active.")
+        cursor = await execute(self.conn, query, vars, cursor_factory, callback)
+        return result(cursor) if result else cursor
@@ -0,0 +1,218 @@
+"""
+Caching of query results in the client.
+
+Pass a *ResultCache* as the *cache* of queries whose results change rarely::
+
+    reference = ResultCache(ttl=300, maxsize=1000)
+    get_countries = Function("get_countries", cache=reference)
+    get_country = FunctionTypedSingle("get_country", ['code'], cache=reference)
+
+A cached call returns a *simpycity.handle.ResultCursor* over rows shared
+with every other call hitting the same entry: treat them as read-only.
+Only calls made through a synchronous handle, outside pipelines and
+without streaming, are cached. The cache doesn't know about transactions:
+a call inside a transaction may see rows cached before its own changes.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import object
+from collections import OrderedDict
+import sys
+import threading
+import time
+import psycopg2
+from simpycity import config as g_config
+from simpycity.handle import ResultCursor
+
+def d_out(text, *args):
+
+    if g_config.debug:
+        print(text % args if args else text)
+
+
+def estimate_size(rows):
+    """
+    :return: rough number of bytes held by *rows*, their values and
+        the attributes of model instances
+    """
+    size = sys.getsizeof(rows)
+    for row in rows:
+        size += sys.getsizeof(row)
+        if isinstance(row, dict):
+            values = row.values()
+        elif isinstance(row, (tuple, list)):
+            values = row
+        elif hasattr(row, 'as_dict'):
+            values = row.as_dict().values()
+        else:
+            values = getattr(row, '__dict__', {}).values()
+        for value in values:
+            size += sys.getsizeof(value)
+    return size
+
+
+class ResultCache(object):
+    """
+    A thread-safe cache of query results, dropping entries after *ttl*
+    seconds and the least recently used ones beyond *maxsize* entries or
+    *maxbytes* estimated bytes.
+
+    Entries are keyed on the query's *query_base*, its sql (which includes
+    the selected columns), its arguments, row type and callback, and on the
+    DSN of the handle, so that a cache can serve queries on several databases.
+    Calls with unhashable arguments are not cached.
+    """
+
+    def __init__(self, ttl=60, maxsize=1024, maxbytes=None):
+        """
+        :param float ttl: seconds an entry is used for; ``None`` keeps entries until evicted
+        :param int maxsize: maximum number of entries
+        :param int maxbytes: maximum estimated size of all entries, see *estimate_size*;
+            ``None`` for no limit
+        """
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.handle = None
+        self.channel = None
+
+    def key(self, query_base, sql, args, cursor_factory=None, callback=None, database=None):
+        """
+        :param str database: identifies the database of the call, e.g. the DSN of its handle
+        :return: the cache key for a call, or ``None`` if it can't be cached
+        """
+        key = (query_base, sql, tuple(args), cursor_factory, callback, database)
+        try:
+            hash(key)
+        except TypeError:
+            return None
+        return key
+
+    def get(self, key):
+        """
+        :return: *simpycity.handle.ResultCursor* over the cached rows, or ``None``
+        """
+        if self.handle is not None:
+            self.poll()
+        with self.lock:
+            try:
+                expires, size, rows, description = self.entries.pop(key)
+            except KeyError:
+                self.misses += 1
+                return None
+            if expires is not None and expires <= time.time():
+                self.bytes -= size
+                self.misses += 1
+                return None
+            self.entries[key] = expires, size, rows, description
+            self.hits += 1
+        return ResultCursor(rows, description)
+
+    def put(self, key, rows, description=None):
+        """
+        Cache *rows*, evicting the least recently used entries as needed.
+        :return: *simpycity.handle.ResultCursor* over *rows*
+        """
+        size = estimate_size(rows)
+        expires = None if self.ttl is None else time.time() + self.ttl
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            if self.maxbytes is None or size <= self.maxbytes:
+                self.entries[key] = expires, size, rows, description
+                self.bytes += size
+                while len(self.entries) > self.maxsize or \
+                        (self.maxbytes is not None and self.bytes > self.maxbytes):
+                    self.bytes -= self.entries.popitem(last=False)[1][1]
+                    self.evictions += 1
+        return ResultCursor(rows, description)
+
+    def invalidate(self, query_base=None):
+        """
+        Drop cached results.
+        :param query_base: drop the results of queries declared with this
+            function, table or sql only; a *simpycity.core.meta_query* stands
+            for its own *query_base*. ``None`` drops everything.
+        """
+        query_base = getattr(query_base, 'query_base', query_base)
+        with self.lock:
+            if query_base is None:
+                self.entries.clear()
+                self.bytes = 0
+                return
+            for key in [key for key in self.entries if key[0] == query_base]:
+                self.bytes -= self.entries.pop(key)[1]
+
+    def clear(self):
+        """Drop all cached results and reset the counters."""
+        self.invalidate()
+        self.hits = self.misses = self.evictions = 0
+
+    def info(self):
+        """
+        :return: dict of hits, misses, evictions, entries and estimated bytes
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'size': len(self.entries), 'bytes': self.bytes}
+
+    def listen(self, handle, channel='simpycity_cache'):
+        """
+        Invalidate entries on PostgreSQL notifications: a notification on
+        *channel* whose payload is a *query_base* drops that query's results,
+        an empty payload drops everything. Send them with *notify*, or from
+        sql, e.g. in a trigger: ``PERFORM pg_notify('simpycity_cache', 'get_countries')``.
+
+        The cache checks for notifications before each lookup. *handle*
+        must not be used for anything else, as it is polled from whichever
+        thread looks up the cache. If it reconnects, the whole cache is
+        dropped, since notifications may have been missed.
+
+        :param simpycity.handle.Handle handle: dedicated handle to listen on
+        :param str channel: notification channel
+        """
+        self.handle = handle
+        self.channel = channel
+        handle.listen(channel)
+        self.backend_pid = handle.backend_pid
+
+    def poll(self):
+        """
+        Apply the notifications received by the listening handle.
+        """
+        with self.lock:
+            handle = self.handle
+            if handle.conn.closed or handle.backend_pid != self.backend_pid:
+                d_out("ResultCache.poll: listening handle reconnected, dropping the cache")
+                handle.listen(self.channel)
+                self.backend_pid = handle.backend_pid
+                payloads = ['']
+            else:
+                try:
+                    payloads = [notify.payload for notify in handle.notifies()
+                                if notify.channel == self.channel]
+                except psycopg2.Error as e:
+                    # the next poll listens again on a new connection
+                    d_out("ResultCache.poll: %s", e)
+                    payloads = ['']
+        for payload in payloads:
+            d_out("ResultCache.poll: invalidating %r", payload)
+            self.invalidate(payload or None)
+
+    def notify(self, handle, query_base=None):
+        """
+        Tell every cache listening on this cache's channel to drop results,
+        once the current transaction of *handle* commits.
+        :param simpycity.handle.Handle handle: handle to send the notification on
+        :param query_base: as for *invalidate*
+        """
+        query_base = getattr(query_base, 'query_base', query_base)
+        handle.execute("SELECT pg_notify(%s, %s)", [self.channel or 'simpycity_cache', query_base or ''])
@@ -15,6 +15,40 @@ password=None
 """libpq connection parameter"""
 debug=False
 """print debug output"""
+query_cache_size=32
+"""maximum number of compiled sql strings kept by each query object; 0 disables the cache"""
+retry_attempts=2
+"""
+times a query is tried when its connection is lost, including the first try; 1 disables retries.
+See *simpycity.handle.RetryPolicy* for when a retry is safe.
+"""
+retry_backoff=0.05
+"""seconds to wait before the first retry; doubled for each further retry"""
+retry_max_backoff=2.0
+"""upper limit in seconds for the wait before a retry"""
+retry_jitter=0.5
+"""up to this fraction of each wait is randomly taken off, so clients don't retry in lockstep"""
+health_check_interval=None
+"""
+seconds between round-trip liveness checks of an idle handle connection; ``None`` disables them,
+leaving only the free check for a connection known to be closed or broken
+"""
+identity_map=False
+"""
+default for *simpycity.handle.Handle.enable_identity_map*: give each handle a map of the model
+instances loaded in its current transaction, so a row is only loaded and instantiated once
+"""
+composite_cache=None
+"""
+path of a JSON file keeping the catalog metadata of composite types registered with
+*simpycity.model.register_composites*, so that processes can start without querying it;
+only used with a *schema_version*
+"""
+schema_version=None
+"""
+identifies the database schema, e.g. the version of the last migration applied:
+change it whenever composite types change, to refresh the *composite_cache*
+"""
 
 def dsn():
     """
@@ -20,14 +20,31 @@ from __future__ import unicode_literals
 from builtins import str
 from builtins import range
 from builtins import object
+from collections import OrderedDict
+import itertools
 import psycopg2
+import psycopg2.extras
 from simpycity import config, ProgrammingError
+from simpycity import instrument
 import simpycity.handle
 
-def d_out(text):
+def d_out(text, *args):
 
     if config.debug:
-        print(text)
+        print(text % args if args else text)
+
+
+stream_ids = itertools.count(1)
+"""source of unique names for streaming cursors"""
+
+def single_row(rows):
+    """
+    :return: the only row in *rows*
+    :raise Exception: unless *rows* holds exactly one row
+    """
+    if len(rows) != 1:
+        raise Exception("Expect only a single row")
+    return rows[0]
 
 
 class meta_query(object):
@@ -35,7 +52,8 @@ class meta_query(object):
     Base object for sql query-like objects For internal use only.
     """
 
-    def __init__(self, name, args=[], handle=None, callback=None):
+    def __init__(self, name, args=[], handle=None, callback=None, prepared=False, row_type=None,
+                 idempotent=False, retry=None, cache=None):
         """
          :param str name:  Sets the base name of the query. How this is used will be
                     declared in the implementing subclass. For instance, in
@@ -50,16 +68,39 @@ class meta_query(object):
          :param function callback:  Each row returned by the cursor will be passed to this function, which must return the row.
                       The function is applied to the psycopg row as returned by psycopg, before any other Simpycity handling.
                       Can be overriden on call-to-call basis via options parameter of the  *__call__* methond.
+         :param boolean prepared:  Run the query as a server-side prepared statement: it is
+                      PREPAREd once per handle connection and then EXECUTEd.
+                      Can be overriden on call-to-call basis via options parameter of the  *__call__* methond.
+         :param row_type:  Return rows as ``'tuple'``, ``'namedtuple'``, ``'dict'`` or the default
+                      ``'dictrow'`` (*psycopg2.extras.DictRow*), see *simpycity.handle.row_cursor*.
+                      Plain tuples are the cheapest to build. Has no effect on typed queries,
+                      which return the value of their single column.
+                      Can be overriden on call-to-call basis via options parameter of the  *__call__* methond.
+         :param boolean idempotent:  The query may safely run twice, so it can be retried
+                      on an autocommit handle after losing the connection.
+         :param simpycity.handle.RetryPolicy retry:  Override *simpycity.handle.default_retry_policy*.
+         :param simpycity.cache.ResultCache cache:  Cache the results of calls.
+                      Can be overriden on call-to-call basis via options parameter of the  *__call__* methond;
+                      ``False`` bypasses the cache.
         """
 
+        self.__compiled__ = OrderedDict()
         self.query_base = name
         self.args = args
         self.__attr__ = {}
 
         self.__attr__['handle'] = handle
         self.__attr__['callback'] = callback
+        self.prepared = prepared
+        self.row_type = row_type
+        self.idempotent = idempotent
+        self.retry = retry
+        self.cache = cache
         self.cursor_factory = simpycity.handle.Cursor
 
+        self.cache_hits = 0
+        self.cache_misses = 0
+
     def __call__(self, *in_args, **in_kwargs):
 
         """
@@ -74,13 +115,24 @@ class meta_query(object):
         * columns: Alters what columns are selected by the query.
         * handle: Overrides the instance handle with a customized version.
         * callback: Override the instance callback with a customized version.
-
-        :return: psycopg2 cursor
+        * prepared: Override the instance prepared flag.
+        * stream: Fetch rows through a named, server-side cursor, *itersize* rows
+          per round trip while iterating, instead of transferring the whole
+          result on execute. Rows are only available by iterating or fetching:
+          rowcount is unknown, so this does not combine with the *Single classes.
+        * itersize: Rows per round trip for a streaming cursor; implies *stream*.
+        * row_type: Override the instance row type.
+        * cache: Override the instance result cache; ``False`` bypasses it.
+
+        :return: psycopg2 cursor, or what the subclass makes of it, see *__result__*.
+            On an asynchronous handle (*simpycity.aio.AsyncHandle*), an awaitable of it;
+            on a handle with an active pipeline (*simpycity.handle.Handle.pipeline*),
+            a *simpycity.handle.Deferred*.
         """
 
-        d_out("meta_query.__call__: query is %s" % self.query_base)
-
-        d_out("meta_query.__call__: Got args %s" % in_kwargs)
+        if config.debug:
+            d_out("meta_query.__call__: query is %s", self.query_base)
+            d_out("meta_query.__call__: Got args %s", in_kwargs)
 
         opts = in_kwargs.pop('options', None)
         if opts:
@@ -94,6 +146,11 @@ class meta_query(object):
         columns = opts.pop('columns', [])
         handle = opts.pop('handle', self.__attr__['handle'])
         callback = opts.pop('callback', self.__attr__['callback'])
+        prepared = opts.pop('prepared', self.prepared)
+        itersize = opts.pop('itersize', None)
+        stream = opts.pop('stream', itersize is not None)
+        row_type = opts.pop('row_type', self.row_type)
+        cache = opts.pop('cache', self.cache)
 
         if len(columns) >= 1:
             # we are limiting the return type.
@@ -101,64 +158,121 @@ class meta_query(object):
             # Until then, we just assume the user knows what they're
             # doing.
             cols = ",".join([x for x in columns])
-            d_out("meta_query.__call__: Called with column limiters: %s" %cols)
+            d_out("meta_query.__call__: Called with column limiters: %s", cols)
 
 
         else:
             cols = "*"
 
-        d_out("meta_query.__call__: Requires args: %s" % len(self.args))
-        d_out("meta_query.__call__: Got args: %i" % (len(in_kwargs) + len(in_args)))
-
-        d_out("in_args: %s" % str(in_args))
-        d_out("in_kwargs: %s" % str(in_kwargs))
+        if config.debug:
+            d_out("meta_query.__call__: Requires args: %s", len(self.args))
+            d_out("meta_query.__call__: Got args: %i", len(in_kwargs) + len(in_args))
+            d_out("in_args: %s", in_args)
+            d_out("in_kwargs: %s", in_kwargs)
+
+        call_list = self.__bind__(in_args, in_kwargs)
+
+        if config.debug:
+            d_out("meta_query.__call__: Handle is %s", handle)
+            d_out("meta_query.__call__: callback is %s", callback)
+        cur = self.__execute__(cols, call_list, handle, callback, extra_opt=opts, prepared=prepared,
+                               stream=stream, itersize=itersize, row_type=row_type, result=self.__result__,
+                               cache=cache)
+        d_out("meta_query.__call__: returning cur of %s", cur)
+        return cur
 
-        # If we were called with arguments
-        if len(in_args) >= 1:
+    def __result__(self, cursor):
+        """
+        Subclass hook turning the executed cursor into the return value of *__call__*.
+        """
+        return cursor
 
-            # Tests if the number of positional arguments + the number of
-            # keyword arguments is less than the number of arguments this
-            # instance was declared to require.
 
-            if len(in_args) < len(self.args) \
-                and len(in_kwargs) < len(self.args) \
-                and len(in_kwargs) + len(in_args) < len(self.args):
-                raise Exception("Insufficient arguments: Expected %s, got %s"
-                                % (len(self.args), len(in_args)+len(in_kwargs)) )
+    @property
+    def query_base(self):
+        """
+        The function, table or sql the query is declared with. Assigning it
+        drops the compiled queries.
+        """
+        return self.__query_base__
 
-            # Tests if the number of positional arguments + the number of
-            # keyword arguments is GREATER than the number of arguments this
-            # instance was declared to require.
+    @query_base.setter
+    def query_base(self, name):
+        self.__query_base__ = name
+        self.__compiled__.clear()
 
-            if len(in_args) > len(self.args) \
-                or len(in_kwargs) > len(self.args) \
-                or len(in_kwargs) + len(in_args) > len(self.args):
-                raise Exception("Too many arguments: Expected %s, got %s" %
-                                (len(self.args), len(in_args)+len(in_kwargs)))
+    @property
+    def args(self):
+        """
+        List of argument names. Assigning it recompiles the argument binder;
+        modify it by assignment rather than in place.
+        """
+        return self.__args__
+
+    @args.setter
+    def args(self, args):
+        self.__args__ = args
+        # map each argument name to its position once, instead of
+        # searching the list for every keyword argument of every call
+        index = {}
+        for position, name in enumerate(args):
+            index.setdefault(name, position)
+        self.__arg_index__ = index
+        self.__arg_template__ = ['' for x in range(len(args))]
+        # the sql has a placeholder per argument
+        self.__compiled__.clear()
+
+    def __bind__(self, in_args, in_kwargs):
+        """
+        Map positional and keyword arguments onto the declared argument list.
+        When called with positional arguments, positional and keyword
+        arguments together must account for every declared argument; when
+        called with keyword arguments alone, missing ones default to ``''``.
+        :return: list of query parameters
+        """
+        nargs = len(self.__arg_template__)
 
-        # Create a fixed-length array equal to the number of arguments
+        # If we were called with arguments
+        if in_args:
+            given = len(in_args) + len(in_kwargs)
+            if given < nargs:
+                raise Exception("Insufficient arguments: Expected %s, got %s" % (nargs, given))
+            if given > nargs:
+                raise Exception("Too many arguments: Expected %s, got %s" % (nargs, given))
+
+        # Copy the fixed-length template equal to the number of arguments
         # this instance requires.
-
-        call_list = ['' for x in range(len(self.args))]
+        call_list = self.__arg_template__[:]
 
         if in_kwargs:
             # Map the incoming keyword args positionally, based on the
             # position of argument names in the core argument list.
-
-            for arg in in_kwargs.keys():
+            index = self.__arg_index__
+            for arg, value in in_kwargs.items():
                 try:
-                    call_list[ self.args.index(arg) ] = in_kwargs[arg]
-                except ValueError:
+                    call_list[index[arg]] = value
+                except KeyError:
                     raise Exception("Unknown keyword argument passed: %s" % arg)
 
-        for index,arg in enumerate(in_args):
-            call_list[index] = arg
-        d_out("meta_query.__call__: Handle is %s" % handle)
-        d_out("meta_query.__call__: callback is %s" % callback)
-        cur = self.__execute__(cols, call_list, handle, callback, extra_opt=opts)
-        d_out("meta_query.__call__: returning cur of %s" % cur)
-        return cur
+        if in_args:
+            call_list[:len(in_args)] = in_args
+        return call_list
+
+    def sql(self, *in_args, **in_kwargs):
+        """
+        The sql and parameters a call with these arguments would execute,
+        e.g. to embed the query in a larger statement such as ``COPY``.
+        Takes the same arguments as *__call__*; of the options, only
+        *columns* and those used by *form_query* apply.
 
+        :return: tuple of sql string and list of parameters
+        """
+        opts = dict(in_kwargs.pop('options', None) or {})
+        columns = opts.pop('columns', [])
+        for name in ('handle', 'callback', 'prepared', 'stream', 'itersize', 'row_type', 'cache'):
+            opts.pop(name, None)
+        cols = ",".join(columns) if columns else "*"
+        return self.compile_query(cols, options=opts), self.__bind__(in_args, in_kwargs)
 
     @property
     def is_property(self):
@@ -184,6 +298,81 @@ class meta_query(object):
         """
         pass
 
+    def query_key(self, columns, options={}):
+        """
+        Subclass function returning a hashable key that identifies the sql
+        *form_query* produces for these arguments, or ``None`` if the sql
+        can't be reused. Override it alongside *form_query* when the query
+        depends on options beyond the ones the superclass knows about: a
+        class overriding *form_query* alone gets its sql built on every call.
+        :param str columns: literal sql string for list of columns
+        :param dict options: dict passed to *form_query*
+        :return: hashable key or ``None``
+        """
+        return None
+
+    def compile_query(self, columns, options={}):
+        """
+        Returns *form_query* for these arguments, reusing the sql built by
+        an earlier call when *query_key* allows it.
+        At most *simpycity.config.query_cache_size* queries are kept; the least
+        recently used one is dropped first.
+        :param str columns: literal sql string for list of columns
+        :param dict options: dict passed to *form_query*
+        :return: sql string
+        """
+        key = self.query_key(columns, options) if self.__cacheable__() else None
+        if key is None:
+            return self.form_query(columns, options=options)
+
+        compiled = self.__compiled__
+        try:
+            query = compiled.pop(key)
+        except KeyError:
+            self.cache_misses += 1
+            query = self.form_query(columns, options=options)
+            if config.query_cache_size <= 0:
+                return query
+            while len(compiled) >= config.query_cache_size:
+                compiled.popitem(last=False)
+        else:
+            self.cache_hits += 1
+
+        compiled[key] = query
+        return query
+
+    @classmethod
+    def __cacheable__(cls):
+        """
+        Private method.
+        :return: whether *query_key* is declared by the class declaring *form_query*,
+            so that its keys account for everything the sql depends on
+        """
+        cacheable = cls.__dict__.get('__cacheable_sql__')
+        if cacheable is None:
+            def declaring(name):
+                return next(base for base in cls.__mro__ if name in base.__dict__)
+            cacheable = declaring('query_key') is declaring('form_query')
+            setattr(cls, '__cacheable_sql__', cacheable)
+        return cacheable
+
+    def query_cache_info(self):
+        """
+        :return: dict of hits, misses, current size and maximum size of the compiled query cache
+        """
+        return {'hits': self.cache_hits,
+                'misses': self.cache_misses,
+                'size': len(self.__compiled__),
+                'maxsize': config.query_cache_size}
+
+    def clear_query_cache(self):
+        """
+        Drops all compiled queries and resets the hit/miss counters.
+        """
+        self.__compiled__.clear()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
     def handle(self, handle):
 
         """
@@ -191,46 +380,241 @@ class meta_query(object):
         """
         self.__attr__['handle'] = handle
 
-    def __execute__(self, columns, call_list, handle=None, callback=None, extra_opt={}):
-        '''
-        Runs the stored query in a psycopg2 cursor based on the arguments provided to
-        *__call__*.
-        If the instance handle is ``None`` and also the handle parameter is ``None``, a handle
-        is created from *simpycity.config.handle_factory*.
-        :param dict extra_opt: a dict passed to *form_query*
-        :return: psycopg2 cursor
-        '''
-
-        query = self.form_query(columns, options=extra_opt)
-
-        d_out("meta_query __execute__: Handle is %s" % handle)
+    def __cursor_factory__(self, row_type=None):
+        """
+        :return: the cursor class for *row_type*, or the instance cursor_factory
+            if *row_type* is ``None`` or this is a typed query
+        """
+        if row_type is None or issubclass(self.cursor_factory, simpycity.handle.TypedCursor):
+            return self.cursor_factory
+        return simpycity.handle.row_cursor(row_type)
 
+    def __handle__(self, handle=None):
+        """
+        :return: *handle* if given, else the instance handle, created from
+            *simpycity.config.handle_factory* if the instance has none yet.
+            A handle checked out of a *simpycity.pool.HandlePool* is not kept
+            as the instance handle: it serves a single call, see *__pooled__*.
+        """
         if handle is None:
             if self.__attr__['handle'] is None:
                 d_out("meta_query.__execute__: Did not find handle, creating new.. ")
                 handle = config.handle_factory()
-                self.__attr__['handle'] = handle
-                d_out("meta_query.__execute__: Handle is %s" % self.__attr__['handle'])
+                if getattr(handle, 'pool', None) is None:
+                    self.__attr__['handle'] = handle
+                d_out("meta_query.__execute__: Handle is %s", handle)
             else:
                 d_out("meta_query.__execute__: Found object handle.. ")
                 handle = self.__attr__['handle']
+        return handle
 
-        cursor = handle.cursor(cursor_factory=self.cursor_factory, callback=callback)
-        d_out("meta_query.__execute__: Cursor is %s" % cursor)
-        d_out("meta_query.__execute__: Query: %s" % ( query ) )
-        d_out("meta_query.__execute__: Call List: %s" % ( call_list ) )
+    def __pooled__(self, given, handle):
+        """
+        Private method.
+        :return: whether *handle*, returned by *__handle__* for the handle
+            *given* to a call, was checked out of a pool for that call only
+        """
+        return given is None and handle is not self.__attr__['handle']
 
-        try:
-            cursor.execute(query, call_list)
+    def __execute__(self, columns, call_list, handle=None, callback=None, extra_opt={}, prepared=False,
+                    stream=False, itersize=None, row_type=None, result=None, cache=None):
+        '''
+        Runs the stored query in a psycopg2 cursor based on the arguments provided to
+        *__call__*.
+        If the instance handle is ``None`` and also the handle parameter is ``None``, a handle
+        is created from *simpycity.config.handle_factory*. A handle checked out
+        of a *simpycity.pool.HandlePool* that way serves this call only: the
+        rows are read, the transaction is committed and the handle is checked
+        back in before the call returns.
+        :param dict extra_opt: a dict passed to *form_query*
+        :param boolean prepared: execute through *simpycity.handle.Handle.prepare*
+        :param boolean stream: execute in a named, server-side cursor. Statements
+            can't be both prepared and streamed: *prepared* is ignored.
+        :param int itersize: rows per round trip for a streaming cursor
+        :param row_type: see *__init__*
+        :param function result: applied to the cursor before it is returned
+        :param simpycity.cache.ResultCache cache: serve the rows from this cache,
+            or fetch them all and cache them
+        :return: psycopg2 cursor, or an awaitable of it if the handle is asynchronous,
+            or a *simpycity.handle.Deferred* if the handle has an active pipeline.
+            Asynchronous and pipelined calls are neither prepared nor retried.
+        '''
 
-        except psycopg2.OperationalError as e:
-            # retry query on stale connection error
-            d_out("OperationalError: %s" % e)
+        query = self.compile_query(columns, options=extra_opt)
+
+        d_out("meta_query __execute__: Handle is %s", handle)
+        given, handle = handle, self.__handle__(handle)
+        if self.__pooled__(given, handle):
+            try:
+                if stream:
+                    raise ProgrammingError("Streaming calls need a handle of their own, not one from a pool.")
+                cursor = self.__execute__(columns, call_list, handle, callback, extra_opt, prepared,
+                                          itersize=itersize, row_type=row_type, cache=cache)
+                rows = cursor.fetchall() if cursor.description is not None else []
+                handle.commit()
+            finally:
+                handle.close()
+            buffered = simpycity.handle.ResultCursor(rows, cursor.description)
+            buffered.rowcount = cursor.rowcount
+            return result(buffered) if result else buffered
+
+        cursor_factory = self.__cursor_factory__(row_type)
+        pipeline = getattr(handle, 'active_pipeline', None)
+        if pipeline is not None:
+            if stream:
+                raise ProgrammingError("Streaming calls can't be pipelined.")
+            return pipeline.add(query, call_list, cursor_factory=cursor_factory,
+                                callback=callback, result=result)
+        if getattr(handle, 'is_async', False):
+            if stream:
+                raise ProgrammingError("Asynchronous handles can't stream results.")
+            return handle.execute(query, call_list, cursor_factory=cursor_factory,
+                                  callback=callback, result=result)
+
+        cursor_args = {'cursor_factory': cursor_factory, 'callback': callback}
+        if stream:
+            # DECLARE only accepts a SELECT, not an EXECUTE
+            prepared = False
+            cursor_args['name'] = 'simpycity_stream_{0}'.format(next(stream_ids))
+
+        key = None
+        if cache and not stream:
+            key = cache.key(self.query_base, query, call_list, cursor_factory, callback,
+                            getattr(handle, 'dsn', None))
+            if key is not None:
+                cursor = cache.get(key)
+                if cursor is not None:
+                    return result(cursor) if result else cursor
+
+        listeners = instrument.listeners()
+        event = None
+        if listeners:
+            event = instrument.QueryEvent(self.query_base, query, call_list, listeners)
+            event.before_execute()
+
+        policy = self.retry or simpycity.handle.default_retry_policy
+        attempt = 1
+        while True:
+            cursor = handle.cursor(**cursor_args)
+            if itersize:
+                cursor.itersize = itersize
+            if config.debug:
+                d_out("meta_query.__execute__: Cursor is %s", cursor)
+                d_out("meta_query.__execute__: Query: %s", query)
+                d_out("meta_query.__execute__: Call List: %s", call_list)
+
+            # a handle without a connection to inspect is never retried; status
+            # is kept by psycopg2, unlike get_transaction_status() which asks libpq
+            conn = getattr(handle, 'conn', None)
+            was_idle = conn is not None and conn.status == psycopg2.extensions.STATUS_READY
+            try:
+                # a reconnected handle has lost its prepared statements:
+                # prepare() issues them again
+                cursor.execute(handle.prepare(query) if prepared else query, call_list)
+            except psycopg2.OperationalError as e:
+                d_out("OperationalError: %s", e)
+                if not policy.should_retry(handle, attempt, was_idle, self.idempotent):
+                    if event is not None:
+                        event.after_execute(error=e)
+                    raise
+                if event is not None:
+                    event.retry(e)
+                policy.wait(attempt)
+                attempt += 1
+                # retry query on stale connection error
+                handle.__reconnect__()
+                continue
+            except Exception as e:
+                if event is not None:
+                    event.after_execute(error=e)
+                raise
+
+            if attempt > 1:
+                policy.count('recovered')
+            if event is not None:
+                event.after_execute(cursor)
+            if key is not None:
+                cursor = cache.put(key, cursor.fetchall(), cursor.description)
+            return result(cursor) if result else cursor
+
+    def many(self, calls, options=None, page_size=100, fetch=True):
+        """
+        Run the query once for each argument list in *calls*, sending up to
+        *page_size* calls to the server in a single statement.
+
+        :param calls: iterable of argument lists. An item that is a dict is
+            passed as keyword arguments, anything else as positional arguments.
+        :param dict options: as for *__call__*, applied to every call
+        :param int page_size: number of calls per round trip
+        :param boolean fetch: when ``False``, results are discarded and the calls
+            are sent with *psycopg2.extras.execute_batch*; use this for
+            statements that return nothing, such as Raw INSERTs
+        :return: list with one entry per call, in input order: the list of rows
+            that call returned. ``None`` when *fetch* is ``False``.
+        """
+        opts = dict(options) if options else {}
+        given = opts.pop('handle', None)
+        handle = self.__handle__(given)
+        if self.__pooled__(given, handle):
+            # as for __execute__, the pooled handle serves these calls only
+            try:
+                results = self.many(calls, dict(opts, handle=handle), page_size, fetch)
+                handle.commit()
+            finally:
+                handle.close()
+            return results
+        columns = opts.pop('columns', [])
+        callback = opts.pop('callback', self.__attr__['callback'])
+        cursor_factory = self.__cursor_factory__(opts.pop('row_type', self.row_type))
+        opts.pop('prepared', None)
+        opts.pop('stream', None)
+        opts.pop('itersize', None)
+
+        cols = ",".join(columns) if columns else "*"
+        query = self.compile_query(cols, options=opts)
+
+        call_lists = []
+        for call in calls:
+            if isinstance(call, dict):
+                call_lists.append(self.__bind__((), call))
+            else:
+                call_lists.append(self.__bind__(tuple(call), {}))
 
+        if not fetch:
             cursor = handle.cursor()
-            cursor.execute(query, call_list)
-
-        return cursor
+            psycopg2.extras.execute_batch(cursor, query, call_lists, page_size=page_size)
+            return None
+
+        typed = issubclass(cursor_factory, simpycity.handle.TypedCursor)
+        # Each call becomes one branch of a UNION ALL, tagged with its position
+        # and the row's position within the call so results can be put back
+        # in order and split per call.
+        # the query may hold braces, e.g. in array literals: it is not formatted
+        branch = " AS simpycity_call, row_number() OVER () AS simpycity_row, t.* FROM (" + query + ") t"
+        results = [[] for x in range(len(call_lists))]
+        for start in range(0, len(call_lists), page_size):
+            page = call_lists[start:start + page_size]
+            page_query = " UNION ALL ".join(
+                ["SELECT " + str(start + i) + branch for i in range(len(page))]) + " ORDER BY 1, 2"
+            params = [param for call_list in page for param in call_list]
+
+            cursor = handle.cursor(cursor_factory=psycopg2.extensions.cursor)
+            d_out("meta_query.many: Query: %s", page_query)
+            cursor.execute(page_query, params)
+            if not typed:
+                build = cursor_factory.row_builder(cursor.description[2:])
+            for row in cursor.fetchall():
+                if typed:
+                    value = row[2:]
+                    if callback:
+                        value = callback(value)
+                    value = value[0]
+                else:
+                    value = build(row[2:])
+                    if callback:
+                        value = callback(value)
+                results[row[0]].append(value)
+        return results
 
     def commit(self):
 
@@ -265,6 +649,9 @@ class Function(meta_query):
         self.direct = kwargs.pop('direct', False)
         super(Function, self).__init__(*args, **kwargs)
 
+    def query_key(self, columns, options={}):
+        return (columns, bool(options.get('direct', self.direct)))
+
     def form_query(self, columns, options={}):
         """
         :param str columns: literal sql string for list of columns
@@ -293,13 +680,21 @@ class FunctionSingle(Function):
     """
     A Postgresql function that returns a single value.
     """
-    def __call__(self, *in_args, **in_kwargs):
-        cursor = super(FunctionSingle, self).__call__(*in_args, **in_kwargs)
+    def __result__(self, cursor):
         if cursor.rowcount != 1:
             raise Exception("Expect only a single row")
         row = cursor.fetchone()
         return row
 
+    def many(self, calls, **kwargs):
+        """
+        As *meta_query.many*, but each call's entry is its single row.
+        """
+        rows = super(FunctionSingle, self).many(calls, **kwargs)
+        if rows is not None:
+            rows = [single_row(_) for _ in rows]
+        return rows
+
 
 class FunctionTyped(Function):
     """A Postgresql function that returns row(s) having only a single (typically composite) column"""
@@ -332,14 +727,23 @@ class Raw(meta_query):
     """
     Execute arbitrary sql.
     """
-    def __init__(self, name, args=[], handle=None, callback=None):
+    def __init__(self, name, args=[], handle=None, callback=None, prepared=False, row_type=None,
+                 idempotent=False, retry=None, cache=None):
         """
         :param str name: The raw sql
         :param args: noop
         :param handle: see superclass
         :param callback: see superclass
+        :param prepared: see superclass
+        :param row_type: see superclass
+        :param idempotent: see superclass
+        :param retry: see superclass
+        :param cache: see superclass
         """
-        super(Raw, self).__init__(name, args, handle, callback)
+        super(Raw, self).__init__(name, args, handle, callback, prepared, row_type, idempotent, retry, cache)
+
+    def query_key(self, columns, options={}):
+        return self.query_base
 
     def form_query(self, columns, options={}):
         #TODO: use args for parameterized query
@@ -349,16 +753,25 @@ class Query(meta_query):
     """
     select query access to a Postgresql table or view.
     """
-    def __init__(self, name, args=[], handle=None, callback=None):
+    def __init__(self, name, args=[], handle=None, callback=None, prepared=False, row_type=None,
+                 idempotent=True, retry=None, cache=None):
         """
         :param str name: table or view name
         :param list args: list of column names used in sql WHERE clause
         :param handle: see superclass
         :param callback: see superclass
+        :param prepared: see superclass
+        :param row_type: see superclass
+        :param idempotent: see superclass; defaults to ``True``, a select being read-only
+        :param retry: see superclass
+        :param cache: see superclass
         """
-        super(Query, self).__init__(name, args, handle, callback)
+        super(Query, self).__init__(name, args, handle, callback, prepared, row_type, idempotent, retry, cache)
         self.direct = False
 
+    def query_key(self, columns, options={}):
+        return (columns, self.direct)
+
     def form_query(self, columns, options={}):
         where_list = None
         if len(self.args) >= 1:
@@ -379,13 +792,21 @@ class QuerySingle(Query):
     """
     A select query on a table or view that returns a single row
     """
-    def __call__(self, *in_args, **in_kwargs):
-        cursor = super(QuerySingle, self).__call__(*in_args, **in_kwargs)
+    def __result__(self, cursor):
         if cursor.rowcount != 1:
             raise Exception("Expect only a single row")
         row = cursor.fetchone()
         return row
 
+    def many(self, calls, **kwargs):
+        """
+        As *meta_query.many*, but each call's entry is its single row.
+        """
+        rows = super(QuerySingle, self).many(calls, **kwargs)
+        if rows is not None:
+            rows = [single_row(_) for _ in rows]
+        return rows
+
 
 class QueryTyped(Query):
     """A select query on a table or view that returns composite row values"""
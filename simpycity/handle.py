@@ -2,92 +2,690 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 from __future__ import unicode_literals
+from builtins import bytes
 from builtins import str
 from builtins import next
 from builtins import object
+import binascii
+import datetime
+import functools
+import io
+import json
+import numbers
+import random
+import re
+import threading
+import time
+import uuid
+from collections import namedtuple, OrderedDict
 import psycopg2.extras
-from simpycity import config as g_config
+from simpycity import config as g_config, ProgrammingError
+from simpycity import instrument
 from contextlib import contextmanager
+from future.utils import string_types
+try:
+    import queue
+except ImportError:
+    import Queue as queue
 
-def d_out(text):
+PLACEHOLDER_RE = re.compile(r'%([%s])')
 
+COPY_FORMATS = ('text', 'csv', 'binary')
+COPY_ESCAPE_RE = re.compile(r'[\\\t\n\r]')
+COPY_ESCAPES = {'\\': '\\\\', '\t': '\\t', '\n': '\\n', '\r': '\\r'}
+COPY_UNESCAPE_RE = re.compile(r'\\(.)')
+COPY_UNESCAPES = {'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+
+def d_out(text, *args):
+    """
+    Print *text* when debugging is on. Any *args* are %-formatted into *text*
+    only then, so call sites cost next to nothing with debugging off.
+    """
     if g_config.debug:
-        print(text)
+        print(text % args if args else text)
+
+
+def format_copy_value(value):
+    """
+    :param value: a string, number, boolean, *uuid.UUID*, date, time or datetime,
+        bytes (for bytea; on Python 2, the bytes of *builtins*, as a native str is text),
+        dict or *psycopg2.extras.Json* (for json), or a list or tuple of those
+        (for an array). Naive datetimes are read in the session time zone.
+    :return: the text Postgresql reads as the value, before COPY escaping
+    :raise TypeError: for other types
+    """
+    # on Python 2, a native str is text too, though it passes for the bytes of builtins
+    if isinstance(value, string_types) and type(value) is not bytes:
+        return value
+    if isinstance(value, bool):
+        return 't' if value else 'f'
+    if isinstance(value, (numbers.Number, uuid.UUID)):
+        return str(value)
+    if isinstance(value, (datetime.date, datetime.time)):
+        return value.isoformat()
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return '\\x' + binascii.hexlify(bytes(value)).decode('ascii')
+    if isinstance(value, dict):
+        return json.dumps(value)
+    if isinstance(value, psycopg2.extras.Json):
+        return json.dumps(value.adapted)
+    if isinstance(value, (list, tuple)):
+        elements = []
+        for element in value:
+            if element is None:
+                elements.append('NULL')
+            elif isinstance(element, (list, tuple)):
+                elements.append(format_copy_value(element))
+            else:
+                text = format_copy_value(element)
+                elements.append('"' + text.replace('\\', '\\\\').replace('"', '\\"') + '"')
+        return '{' + ','.join(elements) + '}'
+    raise TypeError("Cannot COPY a value of type %s" % type(value).__name__)
 
 
-class Cursor(psycopg2.extras.DictCursor):
+def format_copy_row(row):
     """
-    Add per-row callback option to standard cursor.
+    :param row: sequence of values, see *format_copy_value*
+    :return: the row as a line of COPY text format; ``None`` becomes NULL
+    """
+    fields = []
+    for value in row:
+        if value is None:
+            fields.append('\\N')
+        else:
+            fields.append(COPY_ESCAPE_RE.sub(lambda m: COPY_ESCAPES[m.group(0)], format_copy_value(value)))
+    return '\t'.join(fields) + '\n'
+
+
+def parse_copy_line(line):
+    """
+    :param str line: a line of COPY text format, without its newline
+    :return: tuple of column values as strings, NULL as ``None``
+    """
+    return tuple(None if field == '\\N' else
+                 COPY_UNESCAPE_RE.sub(lambda m: COPY_UNESCAPES.get(m.group(1), m.group(1)), field)
+                 for field in line.split('\t'))
+
+
+class CopyReader(io.TextIOBase):
+    """
+    A read-only file serving an iterable of rows in COPY text format,
+    for *Handle.copy_in*.
+    """
+    def __init__(self, rows):
+        self.rows = iter(rows)
+        self.buffer = ''
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        parts = [self.buffer]
+        length = len(self.buffer)
+        while size is None or size < 0 or length < size:
+            try:
+                line = format_copy_row(next(self.rows))
+            except StopIteration:
+                break
+            parts.append(line)
+            length += len(line)
+        data = ''.join(parts)
+        if size is None or size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+
+class CopyWriter(io.TextIOBase):
+    """
+    A write-only file that splits COPY output into lines and puts them on
+    a queue, for *Handle.copy_rows*. Once *stopped*, output is discarded.
+    """
+    def __init__(self, lines):
+        self.lines = lines
+        self.pending = ''
+        self.stopped = False
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        if not self.stopped:
+            lines = (self.pending + data).split('\n')
+            self.pending = lines.pop()
+            for line in lines:
+                self.put(line)
+        return len(data)
+
+    def put(self, item):
+        while not self.stopped:
+            try:
+                self.lines.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                pass
+
+
+class RowShape(object):
+    """
+    Stands in for a cursor when building *psycopg2.extras.DictRow* instances
+    from rows fetched elsewhere.
+    """
+    def __init__(self, description):
+        self.description = description
+        self.index = OrderedDict()
+        for i, column in enumerate(description):
+            self.index[column[0]] = i
+
+
+class CallbackMixin(object):
+    """
+    Add per-row callback option to a psycopg2 cursor class.
     """
     def __init__(self, *args, **kwargs):
         """
         :param function callback: each row will be passed to this function, which must return a row
         """
         self.callback = kwargs.pop('callback', None)
-        super(Cursor, self).__init__(*args, **kwargs)
+        super(CallbackMixin, self).__init__(*args, **kwargs)
+
+    event = None
+    """*simpycity.instrument.QueryEvent* fetches are reported to, while instrumenting"""
 
     def fetchone(self):
-        row = super(Cursor, self).fetchone()
+        if self.event is None:
+            row = super(CallbackMixin, self).fetchone()
+        else:
+            row = instrument.fetchone(self.event, super(CallbackMixin, self).fetchone)
         if self.callback:
             row = self.callback(row)
         return row
 
     def fetchall(self):
-        rows = super(Cursor, self).fetchall()
+        if self.event is None:
+            rows = super(CallbackMixin, self).fetchall()
+        else:
+            rows = instrument.fetch(self.event, super(CallbackMixin, self).fetchall)
         if self.callback:
             rows = [self.callback(_) for _ in rows]
         return rows
 
     def fetchmany(self, size=None):
-        rows = super(Cursor, self).fetchmany(size)
+        if self.event is None:
+            rows = super(CallbackMixin, self).fetchmany(size)
+        else:
+            rows = instrument.fetch(self.event, super(CallbackMixin, self).fetchmany, size)
         if self.callback:
             rows = [self.callback(_) for _ in rows]
         return rows
 
     def __iter__(self):
-        res = super(Cursor, self).__iter__()
-        while True:
-            if self.callback:
-                yield self.callback(next(res))
+        callback = self.callback
+        rows = super(CallbackMixin, self).__iter__()
+        if self.event is not None:
+            rows = instrument.iterate(self.event, rows)
+        for row in rows:
+            if callback:
+                yield callback(row)
             else:
-                yield next(res)
+                yield row
+
+
+class Cursor(CallbackMixin, psycopg2.extras.DictCursor):
+    """
+    Add per-row callback option to standard cursor. Rows are *psycopg2.extras.DictRow*.
+    """
+
+    @staticmethod
+    def row_builder(description):
+        """
+        :param description: cursor description of the row values
+        :return: function making a row of this cursor's type from a tuple of values
+        """
+        shape = RowShape(description)
+        def build(values):
+            row = psycopg2.extras.DictRow(shape)
+            row[:] = values
+            return row
+        return build
+
+
+class TupleCursor(CallbackMixin, psycopg2.extensions.cursor):
+    """
+    A callback cursor returning plain tuples: the cheapest row type.
+    """
 
+    @staticmethod
+    def row_builder(description):
+        return tuple
 
-class TypedCursor(Cursor):
+
+class NamedTupleCursor(CallbackMixin, psycopg2.extras.NamedTupleCursor):
+    """
+    A callback cursor returning named tuples. The namedtuple class is
+    created once per list of column names and shared between cursors.
+    """
+    row_classes = {}
+    max_row_classes = 512
+
+    @classmethod
+    def row_class(cls, names):
+        """
+        :param tuple names: column names
+        :return: namedtuple class with those fields
+        """
+        try:
+            return cls.row_classes[names]
+        except KeyError:
+            pass
+        if len(cls.row_classes) >= cls.max_row_classes:
+            cls.row_classes.clear()
+        row_class = namedtuple('Record', names, rename=True)
+        cls.row_classes[names] = row_class
+        return row_class
+
+    def _make_nt(self):
+        return self.row_class(tuple(d[0] for d in self.description or ()))
+
+    @classmethod
+    def row_builder(cls, description):
+        return cls.row_class(tuple(d[0] for d in description))._make
+
+
+class RealDictCursor(CallbackMixin, psycopg2.extras.RealDictCursor):
+    """
+    A callback cursor returning rows as dicts keyed by column name.
+    """
+
+    @staticmethod
+    def row_builder(description):
+        names = [d[0] for d in description]
+        return lambda values: psycopg2.extras.RealDictRow(zip(names, values))
+
+
+ROW_TYPES = {
+    'dictrow': Cursor,
+    psycopg2.extras.DictRow: Cursor,
+    'tuple': TupleCursor,
+    tuple: TupleCursor,
+    'namedtuple': NamedTupleCursor,
+    'dict': RealDictCursor,
+    dict: RealDictCursor,
+}
+"""cursor classes for each *row_type*"""
+
+def row_cursor(row_type):
+    """
+    :param row_type: ``'dictrow'`` (the default *Cursor*), ``'tuple'``, ``'namedtuple'``
+        or ``'dict'``; the types ``tuple``, ``dict`` and *psycopg2.extras.DictRow* are accepted too
+    :return: the cursor class producing rows of *row_type*
+    """
+    try:
+        return ROW_TYPES[row_type]
+    except (KeyError, TypeError):
+        raise ValueError("Unknown row_type: {0!r}".format(row_type))
+
+
+class TypedCursor(psycopg2.extensions.cursor):
     """
     A cursor for result sets having only a single (typically composite) column.
     Rather than a row being a tuple, it is simply the value of the one column.
+    The callback, if any, receives the row as a *psycopg2.extras.DictRow*, as
+    from a *Cursor*, before it is unwrapped.
+
+    Rows are fetched as plain tuples, *arraysize* at a time while iterating
+    (*itersize* for a named cursor), and unwrapped in the same pass that
+    applies the callback. Only rows passed to a callback are made DictRows.
     """
+    block_size = 1000
+    """default arraysize: rows fetched per block while iterating"""
+
+    def __init__(self, *args, **kwargs):
+        """
+        :param function callback: each row will be passed to this function, which must return a row
+        """
+        self.callback = kwargs.pop('callback', None)
+        super(TypedCursor, self).__init__(*args, **kwargs)
+        self.arraysize = self.block_size
+        self.built_for = None
+        self.build = None
+
+    def __builder__(self):
+        """
+        :return: function making the *psycopg2.extras.DictRow* passed to the callback from a row tuple
+        """
+        description = self.description
+        if self.built_for != description:
+            self.build = Cursor.row_builder(description)
+            self.built_for = description
+        return self.build
+
+    event = None
+    """*simpycity.instrument.QueryEvent* fetches are reported to, while instrumenting"""
+
     def execute(self, query, vars=None):
         super(TypedCursor, self).execute(query, vars)
+        # a named cursor has no description until the first fetch, an
+        # asynchronous one until the query completes
+        if self.name is None and not self.connection.async_:
+            self.check_description()
+
+    def check_description(self):
         if len(self.description) != 1:
             raise Exception("Cursor must return exactly one column")
 
+    def __unwrap__(self, rows):
+        callback = self.callback
+        if callback:
+            build = self.__builder__()
+            return [callback(build(row))[0] for row in rows]
+        return [row[0] for row in rows]
+
     def fetchone(self):
-        row = super(TypedCursor, self).fetchone()
+        if self.event is None:
+            row = super(TypedCursor, self).fetchone()
+        else:
+            row = instrument.fetchone(self.event, super(TypedCursor, self).fetchone)
+        if row is None:
+            return row
+        if self.callback:
+            row = self.callback(self.__builder__()(row))
         if row and len(row) > 0:
             return row[0]
         else:
             return row
 
     def fetchall(self):
-        rows = super(TypedCursor, self).fetchall()
-        rows = [_[0] for _ in rows]
-        return rows
+        if self.event is None:
+            return self.__unwrap__(super(TypedCursor, self).fetchall())
+        return self.__unwrap__(instrument.fetch(self.event, super(TypedCursor, self).fetchall))
 
     def fetchmany(self, size=None):
-        rows = super(TypedCursor, self).fetchmany(size)
-        rows = [_[0] for _ in rows]
-        return rows
+        if size is None:
+            size = self.arraysize
+        if self.event is None:
+            return self.__unwrap__(super(TypedCursor, self).fetchmany(size))
+        return self.__unwrap__(instrument.fetch(self.event, super(TypedCursor, self).fetchmany, size))
 
     def __iter__(self):
-        res = super(TypedCursor, self).__iter__()
+        fetchmany = super(TypedCursor, self).fetchmany
+        if self.event is not None:
+            fetchmany = functools.partial(instrument.fetch, self.event, fetchmany)
+        size = self.itersize if self.name is not None else self.arraysize
+        callback = self.callback
         while True:
-            row = next(res)
-            if row and len(row) > 0:
-                yield row[0]
+            rows = fetchmany(size)
+            if not rows:
+                return
+            if callback:
+                build = self.__builder__()
+                for row in rows:
+                    yield callback(build(row))[0]
             else:
-                yield row
+                for row in rows:
+                    yield row[0]
+
+class ResultCursor(object):
+    """
+    A cursor over rows that have already been fetched, such as the results
+    of a *Pipeline*: it supports the fetch methods, iteration and rowcount
+    of a psycopg2 cursor.
+    """
+    def __init__(self, rows, description=None):
+        """
+        :param list rows: the rows, in their final form
+        :param description: cursor description of the rows, if known
+        """
+        self.rows = rows
+        self.description = description
+        self.rowcount = len(rows)
+        self.rownumber = 0
+        self.arraysize = 1
+
+    def fetchone(self):
+        if self.rownumber >= self.rowcount:
+            return None
+        self.rownumber += 1
+        return self.rows[self.rownumber - 1]
+
+    def fetchmany(self, size=None):
+        start = self.rownumber
+        self.rownumber = min(self.rowcount, start + (size or self.arraysize))
+        return self.rows[start:self.rownumber]
+
+    def fetchall(self):
+        start, self.rownumber = self.rownumber, self.rowcount
+        return self.rows[start:]
+
+    def __iter__(self):
+        while self.rownumber < self.rowcount:
+            yield self.fetchone()
+
+    def close(self):
+        pass
+
+
+class Deferred(object):
+    """
+    The result of a call queued in a *Pipeline*, available once the pipeline is flushed.
+    """
+    def __init__(self, pipeline):
+        self.pipeline = pipeline
+        self.resolved = False
+        self.value = None
+        self.error = None
+
+    def done(self):
+        """
+        :return: True if the call has been sent, and its result or error is known
+        """
+        return self.resolved
+
+    def result(self):
+        """
+        :return: the return value of the call, flushing the pipeline first if needed
+        :raise: the error the call raised
+        """
+        if not self.resolved:
+            self.pipeline.flush()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+    def set(self, value=None, error=None):
+        self.value = value
+        self.error = error
+        self.resolved = True
+
+
+class Pipeline(object):
+    """
+    Collects query calls made while *Handle.pipeline* is active and runs them
+    in a single round trip: one SELECT with one column per call, each
+    holding that call's whole result.
+
+    A typed call (see *TypedCursor*) returns its values as an array. Other
+    calls return an array of their rows as records, decoded with the column
+    types of the query: the first time a handle pipelines a query, it gets them
+    with an extra ``LIMIT 0`` execution, which doesn't fetch any row. Either way,
+    values are decoded by the usual typecasters, and are the same as
+    outside a pipeline. Only queries that can appear in a subselect can be
+    pipelined: functions may modify data, but Raw INSERTs and UPDATEs can't be queued.
+    """
+    def __init__(self, handle):
+        self.handle = handle
+        self.calls = []
+
+    def add(self, query, vars=None, cursor_factory=None, callback=None, result=None):
+        """
+        Queue a call.
+
+        :param str query: sql to run
+        :param list vars: query parameters
+        :param cursor_factory: cursor class the call would have run in; decides how rows are built
+        :param function callback: see *Cursor*
+        :param function result: applied to the *ResultCursor* holding the rows
+        :return: *Deferred* for what *result* returns
+        """
+        deferred = Deferred(self)
+        self.calls.append((query, list(vars or []), cursor_factory or Cursor, callback, result, deferred))
+        return deferred
+
+    def flush(self):
+        """
+        Send the queued calls and resolve their *Deferred* results, in the order queued.
+        If the statement fails, every queued call fails with the same error.
+        """
+        calls, self.calls = self.calls, []
+        if not calls:
+            return
+
+        columns = []
+        params = []
+        for query, vars, cursor_factory, callback, result, deferred in calls:
+            if issubclass(cursor_factory, TypedCursor):
+                columns.append("ARRAY(SELECT * FROM ({0}) t)".format(query))
+            else:
+                columns.append("ARRAY(SELECT t::text FROM ({0}) t)".format(query))
+            params.extend(vars)
+
+        d_out("Pipeline.flush: sending %s calls", len(calls))
+        descriptions = self.handle.__descriptions__
+        try:
+            cursor = self.handle.cursor(cursor_factory=psycopg2.extensions.cursor)
+            for query, vars, cursor_factory, callback, result, deferred in calls:
+                if not issubclass(cursor_factory, TypedCursor) and query not in descriptions:
+                    cursor.execute("SELECT * FROM ({0}) t LIMIT 0".format(query), vars)
+                    descriptions[query] = cursor.description
+            cursor.execute("SELECT " + ", ".join(columns), params)
+            values = cursor.fetchone()
+        except Exception as e:
+            for call in calls:
+                call[-1].set(error=e)
+            raise
+
+        for (query, vars, cursor_factory, callback, result, deferred), value in zip(calls, values):
+            try:
+                rows = self.__cursor__(value, cursor, cursor_factory, callback, descriptions.get(query))
+                deferred.set(result(rows) if result else rows)
+            except Exception as e:
+                deferred.set(error=e)
+
+    def __cursor__(self, value, cursor, cursor_factory, callback, description):
+        if issubclass(cursor_factory, TypedCursor):
+            rows = value or []
+            if callback:
+                rows = [callback((row,))[0] for row in rows]
+            return ResultCursor(rows)
+
+        oids = [column[1] for column in description]
+        build = cursor_factory.row_builder(description)
+        rows = []
+        for record in value or []:
+            tokens = psycopg2.extras.CompositeCaster.tokenize(record)
+            rows.append(build([cursor.cast(oid, token) for oid, token in zip(oids, tokens)]))
+        if callback:
+            rows = [callback(row) for row in rows]
+        return ResultCursor(rows, description)
+
+    def discard(self):
+        """
+        Drop the queued calls; their results raise *simpycity.ProgrammingError*.
+        """
+        calls, self.calls = self.calls, []
+        for call in calls:
+            call[-1].set(error=ProgrammingError("Pipeline was discarded before it was flushed."))
+
+
+class RetryPolicy(object):
+    """
+    Decides whether and when *simpycity.core.meta_query* retries a statement
+    whose connection was lost, and counts what happened.
+
+    A lost connection is one psycopg2 has marked closed after an
+    OperationalError; other errors, such as deadlocks or cancelled
+    statements, are never retried. A retry reconnects the handle, so it is
+    only attempted if the statement was the first of its transaction:
+    otherwise the earlier work of the transaction is gone. In autocommit
+    mode the statement may have committed before the connection dropped,
+    so the query must also be flagged idempotent.
+
+    Settings left ``None`` are read from *simpycity.config* at the time of use.
+    """
+
+    def __init__(self, attempts=None, backoff=None, max_backoff=None, jitter=None):
+        """
+        :param int attempts: see *simpycity.config.retry_attempts*
+        :param float backoff: see *simpycity.config.retry_backoff*
+        :param float max_backoff: see *simpycity.config.retry_max_backoff*
+        :param float jitter: see *simpycity.config.retry_jitter*
+        """
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.jitter = jitter
+        self.lock = threading.Lock()
+        self.retries = 0
+        self.recovered = 0
+        self.gave_up = 0
+
+    def setting(self, name):
+        value = getattr(self, name)
+        if value is None:
+            value = getattr(g_config, 'retry_' + name)
+        return value
+
+    def should_retry(self, handle, attempt, was_idle, idempotent):
+        """
+        :param Handle handle: the handle the statement failed on
+        :param int attempt: number of tries so far
+        :param boolean was_idle: no transaction was open when the statement was sent
+        :param boolean idempotent: the statement may safely run twice
+        :return: True if the statement should be tried again
+        """
+        conn = getattr(handle, 'conn', None)
+        if conn is None or not conn.closed:
+            return False
+        if not was_idle or (handle.autocommit and not idempotent) \
+                or attempt >= self.setting('attempts'):
+            self.count('gave_up')
+            return False
+        return True
+
+    def wait(self, attempt):
+        """
+        Sleep before retry number *attempt*, with exponential backoff and jitter.
+        """
+        delay = min(self.setting('max_backoff'), self.setting('backoff') * 2 ** (attempt - 1))
+        delay *= 1 - self.setting('jitter') * random.random()
+        self.count('retries')
+        if delay > 0:
+            time.sleep(delay)
+
+    def count(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self):
+        """
+        :return: dict of retries made, statements that succeeded after a retry,
+            and statements that failed on a lost connection without being retried
+        """
+        return {'retries': self.retries, 'recovered': self.recovered, 'gave_up': self.gave_up}
+
+
+default_retry_policy = RetryPolicy()
+"""the policy of queries that don't have their own"""
+
+
+class Connection(psycopg2.extensions.connection):
+    """
+    psycopg2 connection of a *Handle*, carrying its identity map to the
+    composite casters, which only see the connection.
+    """
+    identity_map = None
+
 
 class Handle(object):
 
@@ -96,6 +694,9 @@ class Handle(object):
     a Handle is the wrapper object around a psycopg connection.
     """
 
+    is_async = False
+    """queries on this handle return results, rather than awaitables; see *simpycity.aio.AsyncHandle*"""
+
     def __init__(self, dsn=None, config=None, isolation_level=None):
         """
         Open a psycopg2 connection.
@@ -104,6 +705,10 @@ class Handle(object):
         :param isolation_level int: A Postgresql isolation_level: one of 0, 1, 2. See psycopg2 connection docs.
         """
         self.conn = None
+        self.backend_pid = None
+        self.__statements__ = {}
+        # column descriptions of the queries pipelined, see Pipeline
+        self.__descriptions__ = {}
 
         self.config = config or g_config
         self.dsn = dsn or self.config.dsn()
@@ -112,40 +717,222 @@ class Handle(object):
         if isolation_level is not None and isolation_level in [0,1,2]:
             self.isolation_level = isolation_level
 
+        self.health_check_interval = getattr(self.config, 'health_check_interval', None)
+        self.use_identity_map = getattr(self.config, 'identity_map', False)
+        self.next_health_check = None
+        self.active_pipeline = None
+
         d_out("Handle.__init__: Creating DB connection")
         self.__reconnect__()
-        d_out("Handle.__init__: Connection PID is %s" % self.conn.get_backend_pid() )
-
-        if self.isolation_level is not None:
-            self.conn.set_isolation_level(isolation_level)
+        d_out("Handle.__init__: Connection PID is %s", self.backend_pid)
 
     def __reconnect__(self):
         if self.conn and not self.conn.closed:
-            self.close()
+            self.conn.close()
+
+        self.conn = psycopg2.connect(self.dsn, connection_factory=Connection)
+        if self.use_identity_map:
+            self.conn.identity_map = {}
+        if self.isolation_level is not None:
+            self.conn.set_isolation_level(self.isolation_level)
+        self.__schedule_health_check__()
+        # prepared statements live in the backend: a new connection has none
+        self.backend_pid = self.conn.get_backend_pid()
+        self.__statements__ = {}
+        self.__descriptions__ = {}
 
-        self.conn = psycopg2.connect(self.dsn)
+    @property
+    def identity_map(self):
+        """
+        dict of the model instances loaded in the current transaction, keyed
+        by class and primary key, or ``None`` if disabled. See
+        *simpycity.model.SimpleModel.primary_key*.
+        """
+        return self.conn.identity_map if self.conn is not None else None
+
+    def enable_identity_map(self, enabled=True):
+        """
+        Start, or stop, keeping an identity map. It is emptied when the
+        transaction ends or the connection is replaced.
+        """
+        self.use_identity_map = enabled
+        self.conn.identity_map = {} if enabled else None
+
+    def __forget__(self):
+        if self.conn.identity_map:
+            self.conn.identity_map.clear()
 
     def cursor(self,*args,**kwargs):
         """
+        :param name: Open a named, server-side cursor; in autocommit mode it is
+            declared WITH HOLD, as psycopg2 requires
         :param cursor_factory: Override default Cursor
+        :param row_type: Pick the cursor class by row type, see *row_cursor*;
+            ignored if *cursor_factory* is given
         :return: psycopg2 cursor
         """
         d_out("Handle.cursor: Creating cursor..")
         if not self.open:
             raise Exception("Connection isn't open.")
 
+        row_type = kwargs.pop('row_type', None)
         if 'cursor_factory' not in kwargs or kwargs['cursor_factory'] == None:
-            kwargs["cursor_factory"] = Cursor
+            kwargs["cursor_factory"] = Cursor if row_type is None else row_cursor(row_type)
         callback = kwargs.pop('callback', None)
+        if (args or kwargs.get('name')) and self.autocommit:
+            kwargs.setdefault('withhold', True)
         cur = self.conn.cursor(*args,**kwargs)
         if callback:
-            d_out('Handle.cursor() setting callback attrib {0}'.format(callback))
+            d_out('Handle.cursor() setting callback attrib %s', callback)
             cur.callback = callback
         return cur
 
     def execute(self, *args, **kwargs):
         return self.cursor().execute(*args, **kwargs)
 
+    def prepare(self, query):
+        """
+        Issue a server-side PREPARE for *query* the first time it is seen on the
+        current backend, and return the sql that executes the prepared statement.
+        Statements are forgotten when the handle reconnects, and prepared again
+        on next use.
+        :param str query: sql using psycopg2 positional ``%s`` placeholders
+        :return: an ``EXECUTE`` sql string taking the same parameters as *query*
+        """
+        try:
+            return self.__statements__[query]
+        except KeyError:
+            pass
+
+        name = 'simpycity_{0}'.format(len(self.__statements__) + 1)
+        params = []
+        def number(match):
+            if match.group(1) == '%':
+                return '%'
+            params.append('%s')
+            return '${0}'.format(len(params))
+        server_query = PLACEHOLDER_RE.sub(number, query)
+
+        d_out("Handle.prepare: preparing %s on pid %s: %s", name, self.backend_pid, server_query)
+        self.conn.cursor().execute("PREPARE {0} AS {1}".format(name, server_query))
+
+        if params:
+            statement = "EXECUTE {0}({1})".format(name, ",".join(params))
+        else:
+            statement = "EXECUTE {0}".format(name)
+        self.__statements__[query] = statement
+        return statement
+
+    def __copy_query__(self, cursor, query, args=(), kwargs=None):
+        """
+        :param query: sql string, or a *simpycity.core.meta_query* such as a *Query*
+        :return: *query* as sql with its arguments interpolated
+        """
+        if hasattr(query, 'sql'):
+            query, params = query.sql(*args, **(kwargs or {}))
+        else:
+            params = args
+        if params:
+            query = cursor.mogrify(query, params)
+            if isinstance(query, bytes):
+                query = query.decode(psycopg2.extensions.encodings[self.conn.encoding])
+        return query
+
+    @staticmethod
+    def __copy_options__(format, header):
+        if format not in COPY_FORMATS:
+            raise ValueError("COPY format must be one of {0}".format(", ".join(COPY_FORMATS)))
+        if header:
+            return "WITH (FORMAT {0}, HEADER true)".format(format)
+        return "WITH (FORMAT {0})".format(format)
+
+    def copy_out(self, query, fileobj, format='text', header=False, args=(), kwargs=None):
+        """
+        Write the result of *query* to *fileobj* with ``COPY ... TO STDOUT``.
+
+        :param query: sql string, or a *simpycity.core.meta_query* such as a *Query*
+        :param fileobj: file-like object with a *write* method; binary format needs a binary file
+        :param str format: one of ``'text'``, ``'csv'``, ``'binary'``
+        :param boolean header: write a header line (csv only)
+        :param args: positional arguments for *query*
+        :param dict kwargs: keyword arguments for a *meta_query*, including *options*
+        """
+        cursor = self.cursor(cursor_factory=psycopg2.extensions.cursor)
+        query = self.__copy_query__(cursor, query, args, kwargs)
+        sql = "COPY ({0}) TO STDOUT {1}".format(query, self.__copy_options__(format, header))
+        d_out("Handle.copy_out: %s", sql)
+        cursor.copy_expert(sql, fileobj)
+
+    def copy_in(self, table, source, format='text', header=False, columns=None):
+        """
+        Load rows into *table* with ``COPY ... FROM STDIN``.
+
+        :param str table: table name, optionally schema-qualified
+        :param source: file-like object with a *read* method holding data in *format*,
+            or an iterable of rows (sequences of values), sent in text format
+        :param str format: format of a file *source*: one of ``'text'``, ``'csv'``, ``'binary'``
+        :param boolean header: *source* starts with a header line (csv only)
+        :param list columns: column names the values map to, if not all columns in table order
+        :return: number of rows copied
+        """
+        if not hasattr(source, 'read'):
+            source = CopyReader(source)
+            format = 'text'
+        if columns:
+            table = "{0} ({1})".format(table, ",".join(columns))
+        cursor = self.cursor(cursor_factory=psycopg2.extensions.cursor)
+        sql = "COPY {0} FROM STDIN {1}".format(table, self.__copy_options__(format, header))
+        d_out("Handle.copy_in: %s", sql)
+        cursor.copy_expert(sql, source)
+        return cursor.rowcount
+
+    def copy_rows(self, query, args=(), kwargs=None, queue_size=1000):
+        """
+        Generator yielding the rows of *query* as ``COPY ... TO STDOUT`` delivers them.
+        The copy runs in a background thread, at most *queue_size* rows ahead
+        of the consumer. Do not use the handle for anything else until the
+        generator is exhausted or closed; closing it early reads and discards
+        the rest of the output so the connection stays usable.
+
+        :param query: sql string, or a *simpycity.core.meta_query* such as a *Query*
+        :param args: positional arguments for *query*
+        :param dict kwargs: keyword arguments for a *meta_query*, including *options*
+        :return: generator of tuples of column values in Postgresql text
+            output form, NULL as ``None``
+        """
+        lines = queue.Queue(queue_size)
+        writer = CopyWriter(lines)
+        done = object()
+        failure = []
+
+        def copy():
+            try:
+                self.copy_out(query, writer, args=args, kwargs=kwargs)
+            except Exception as e:
+                failure.append(e)
+            finally:
+                writer.put(done)
+
+        thread = threading.Thread(target=copy)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                line = lines.get()
+                if line is done:
+                    break
+                yield parse_copy_line(line)
+        finally:
+            writer.stopped = True
+            while thread.is_alive():
+                try:
+                    lines.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+        if failure:
+            raise failure[0]
+
     @property
     def autocommit(self):
         # We trust the user not to run SQL SET commands directly to
@@ -178,6 +965,7 @@ class Handle(object):
             self.execute("COMMIT")
         else:
             self.conn.commit()
+        self.__forget__()
 
     def rollback(self):
         d_out("Handle.rollback: Abort transaction.")
@@ -189,6 +977,7 @@ class Handle(object):
                 self.execute("ROLLBACK")
             else:
                 self.conn.rollback()
+            self.__forget__()
 
     @contextmanager
     def transaction(self):
@@ -203,9 +992,57 @@ class Handle(object):
             self.rollback()
             raise
 
+    def listen(self, channel):
+        """
+        Subscribe to PostgreSQL notifications on *channel*, committing the
+        current transaction. Collect them with *notifies*.
+        """
+        self.execute("LISTEN " + psycopg2.extensions.quote_ident(channel, self.conn))
+        self.commit()
+
+    def notifies(self):
+        """
+        :return: list of the *psycopg2.extensions.Notify* received since the last call
+        """
+        self.conn.poll()
+        notifies = self.conn.notifies[:]
+        del self.conn.notifies[:]
+        return notifies
+
+    @contextmanager
+    def pipeline(self):
+        """
+        Queue the queries called on this handle until the block ends, then
+        send them in one round trip. Inside the block, calls return a
+        *Deferred* instead of their result::
+
+            with handle.pipeline():
+                user = get_user(1, options={'handle': handle})
+                count = count_orders(1, options={'handle': handle})
+            user.result(), count.result()
+
+        Calling *Deferred.result* inside the block flushes the calls queued so far.
+        If the block raises, the queued calls are discarded. See *Pipeline*.
+
+        :return: the *Pipeline*
+        """
+        if self.active_pipeline is not None:
+            # nested: the outer block flushes
+            yield self.active_pipeline
+            return
+        pipeline = self.active_pipeline = Pipeline(self)
+        try:
+            yield pipeline
+        except:
+            pipeline.discard()
+            raise
+        finally:
+            self.active_pipeline = None
+        pipeline.flush()
+
     def __repr__(self):
         if not self.conn.closed:
-            return "Handle object: pid %s" % self.conn.get_backend_pid()
+            return "Handle object: pid %s" % self.backend_pid
         else:
             return "Handle object: no pid (closed)"
 
@@ -216,7 +1053,7 @@ class Handle(object):
             return
 
         if not self.conn.closed:
-            d_out("handle.close: handle open, closing pid %s" % self.conn.get_backend_pid() )
+            d_out("handle.close: handle open, closing pid %s", self.backend_pid)
             self.conn.close()
         else:
             d_out("handle.close: handle already closed.")
@@ -226,21 +1063,50 @@ class Handle(object):
         if self.conn:
             self.close()
 
+    def __schedule_health_check__(self):
+        if self.health_check_interval is None:
+            self.next_health_check = None
+        else:
+            self.next_health_check = time.time() + self.health_check_interval
+
+    def ping(self):
+        """
+        Check the connection with a round trip, and reconnect if it is dead.
+        Skipped inside a transaction, which a reconnect would silently lose.
+
+        :return: True if the connection answered or was not checked, False if it was replaced
+        """
+        self.__schedule_health_check__()
+        if self.conn.closed:
+            self.__reconnect__()
+            return False
+        if self.conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            return True
+        try:
+            cursor = self.conn.cursor()
+            cursor.execute("SELECT 1")
+            if not self.autocommit:
+                self.conn.rollback()
+            return True
+        except (psycopg2.OperationalError, psycopg2.InterfaceError) as e:
+            d_out("Handle.ping: connection is dead, reconnecting: %s", e)
+            self.__reconnect__()
+            return False
+
     @property
     def open(self):
         """
         Open the connection if not already open.
+        This runs before every query, so it only looks at *conn.closed*, which
+        psycopg2 sets once it sees the connection close or break. Every
+        *health_check_interval* seconds (see *simpycity.config*) it does a
+        round trip through *ping* as well.
 
         :return: True
         """
-        try:
-            if self.conn.get_backend_pid():
-                return True
-        except psycopg2.InterfaceError as e:
-            if str(e) == "connection already closed":
-                # We already lost our connection. Attempt to reforge it.
-                self.__reconnect__()
-                if self.conn.get_backend_pid() >= 0:
-                    return True # Resets it.
-            else:
-                raise e # Another error. Don't try to trap it.
+        if self.conn is None or self.conn.closed:
+            # We already lost our connection. Attempt to reforge it.
+            self.__reconnect__()
+        elif self.next_health_check is not None and time.time() >= self.next_health_check:
+            self.ping()
+        return True
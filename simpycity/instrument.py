@@ -0,0 +1,326 @@
+"""
+Timing and row counts for queries run through *simpycity.core.meta_query*.
+
+Register a hook to observe every query::
+
+    histogram = instrument.Histogram()
+    instrument.register(histogram)
+    ...
+    for key, stats in histogram.slowest(10):
+        print(key, stats['calls'], stats['execute_time'])
+
+or collect the queries run by a block of code, in the current thread or
+asyncio task only::
+
+    with instrument.collect() as collector:
+        render_page()
+    print(len(collector.events), collector.total_time())
+
+Nothing is measured while no hook is registered and no collector is active.
+Queries on asynchronous handles and in pipelines are not instrumented.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import object
+from contextlib import contextmanager
+import threading
+import time
+try:
+    import contextvars
+except ImportError:
+    contextvars = None
+
+timer = getattr(time, 'perf_counter', time.time)
+"""clock used for all measurements"""
+
+hooks = []
+"""hooks notified of every query; see *register*"""
+
+LATENCY_BOUNDS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+"""upper bounds in seconds of the *Histogram* latency buckets; a last bucket takes the rest"""
+
+
+class Hook(object):
+    """
+    Base class for instrumentation hooks: override the methods of interest.
+    Hooks are called synchronously, in the thread running the query.
+    """
+
+    def before_execute(self, event):
+        """Called before the query is sent."""
+
+    def after_execute(self, event):
+        """Called once the query has run, or failed: see *QueryEvent.error*."""
+
+    def on_retry(self, event, error):
+        """Called when the query is retried after losing its connection."""
+
+    def after_fetch(self, event, rows, seconds):
+        """Called after each fetch from the query's cursor, with the rows fetched and the time taken."""
+
+
+class QueryEvent(object):
+    """
+    One execution of a query, as seen by hooks.
+    """
+
+    def __init__(self, query_base, sql, params, listeners):
+        """
+        :param str query_base: the function, table or raw sql the query was declared with
+        :param str sql: the sql sent
+        :param list params: the query parameters
+        :param listeners: the hooks to notify
+        """
+        self.query_base = query_base
+        self.sql = sql
+        self.params = params
+        self.listeners = listeners
+        self.start = None
+        self.execute_time = None
+        """seconds from sending the query until it completed or failed, retries included"""
+        self.rowcount = -1
+        """rows in the result, or -1 if unknown, as for streaming cursors"""
+        self.error = None
+        self.retries = 0
+        self.rows = 0
+        """rows fetched so far"""
+        self.fetch_time = 0.0
+        """seconds spent fetching so far"""
+
+    def before_execute(self):
+        for hook in self.listeners:
+            hook.before_execute(self)
+        self.start = timer()
+
+    def after_execute(self, cursor=None, error=None):
+        self.execute_time = timer() - self.start
+        self.error = error
+        if cursor is not None:
+            self.rowcount = cursor.rowcount
+            cursor.event = self
+        for hook in self.listeners:
+            hook.after_execute(self)
+
+    def retry(self, error):
+        self.retries += 1
+        for hook in self.listeners:
+            hook.on_retry(self, error)
+
+    def fetched(self, rows, seconds):
+        self.rows += rows
+        self.fetch_time += seconds
+        for hook in self.listeners:
+            hook.after_fetch(self, rows, seconds)
+
+    def __repr__(self):
+        return "<QueryEvent %s: %s rows>" % (self.query_base, self.rowcount)
+
+
+def fetch(event, method, *args):
+    """
+    Call the cursor method *fetchall* or *fetchmany*, reporting its rows and time to *event*.
+    :return: the rows
+    """
+    start = timer()
+    rows = method(*args)
+    event.fetched(len(rows), timer() - start)
+    return rows
+
+
+def fetchone(event, method):
+    """
+    Call the cursor method *fetchone*, reporting its row and time to *event*.
+    :return: the row
+    """
+    start = timer()
+    row = method()
+    event.fetched(0 if row is None else 1, timer() - start)
+    return row
+
+
+def iterate(event, rows):
+    """
+    Iterate over cursor rows, reporting their number and the time taken to
+    *event* once the iteration ends.
+    """
+    count = 0
+    seconds = 0.0
+    rows = iter(rows)
+    try:
+        while True:
+            start = timer()
+            try:
+                row = next(rows)
+            except StopIteration:
+                return
+            finally:
+                seconds += timer() - start
+            count += 1
+            yield row
+    finally:
+        event.fetched(count, seconds)
+
+
+class ContextStack(object):
+    """
+    Collectors active in the current context: the asyncio task, where
+    *contextvars* is available, else the thread.
+    """
+
+    def __init__(self):
+        if contextvars is not None:
+            self.var = contextvars.ContextVar('simpycity_collectors', default=())
+        else:
+            self.local = threading.local()
+        self.lock = threading.Lock()
+        self.depth = 0
+        """collectors active in any context"""
+
+    def get(self):
+        if contextvars is not None:
+            return self.var.get()
+        return getattr(self.local, 'stack', ())
+
+    def set(self, stack):
+        if contextvars is not None:
+            self.var.set(stack)
+        else:
+            self.local.stack = stack
+
+    @contextmanager
+    def push(self, collector):
+        stack = self.get()
+        self.set(stack + (collector,))
+        with self.lock:
+            self.depth += 1
+        try:
+            yield collector
+        finally:
+            with self.lock:
+                self.depth -= 1
+            self.set(stack)
+
+
+collectors = ContextStack()
+
+
+def listeners():
+    """
+    :return: the registered hooks plus the collectors of the current context;
+        empty, and cheap to compute, if there are none
+    """
+    if not hooks and not collectors.depth:
+        return ()
+    return tuple(hooks) + collectors.get()
+
+
+def register(hook):
+    """
+    Notify *hook* of every query, in all threads.
+    :param Hook hook: the hook
+    """
+    hooks.append(hook)
+
+
+def unregister(hook):
+    """
+    Stop notifying *hook*.
+    """
+    hooks.remove(hook)
+
+
+class Collector(Hook):
+    """
+    Keeps the *QueryEvent* of every query executed while it is active.
+    """
+
+    def __init__(self):
+        self.events = []
+
+    def after_execute(self, event):
+        self.events.append(event)
+
+    def total_time(self):
+        """
+        :return: seconds spent executing and fetching the collected queries
+        """
+        return sum((event.execute_time or 0.0) + event.fetch_time for event in self.events)
+
+
+def collect():
+    """
+    Context manager collecting the queries run in the current thread or
+    asyncio task while it is active.
+    :return: context manager yielding a *Collector*
+    """
+    return collectors.push(Collector())
+
+
+class Histogram(Hook):
+    """
+    Aggregates calls, errors, retries, rows fetched, execute and fetch time,
+    and a histogram of execute latency (see *LATENCY_BOUNDS*) per *query_base*.
+    Safe to share between threads.
+    """
+
+    def __init__(self, bounds=LATENCY_BOUNDS):
+        """
+        :param bounds: ascending upper bounds of the latency buckets, in seconds
+        """
+        self.bounds = tuple(bounds)
+        self.lock = threading.Lock()
+        self.queries = {}
+
+    def __entry__(self, key):
+        entry = self.queries.get(key)
+        if entry is None:
+            entry = self.queries[key] = {
+                'calls': 0, 'errors': 0, 'retries': 0, 'rows': 0,
+                'execute_time': 0.0, 'max_execute_time': 0.0, 'fetch_time': 0.0,
+                'buckets': [0] * (len(self.bounds) + 1),
+            }
+        return entry
+
+    def after_execute(self, event):
+        seconds = event.execute_time
+        bucket = 0
+        while bucket < len(self.bounds) and seconds > self.bounds[bucket]:
+            bucket += 1
+        with self.lock:
+            entry = self.__entry__(event.query_base)
+            entry['calls'] += 1
+            entry['retries'] += event.retries
+            if event.error is not None:
+                entry['errors'] += 1
+            entry['execute_time'] += seconds
+            entry['max_execute_time'] = max(entry['max_execute_time'], seconds)
+            entry['buckets'][bucket] += 1
+
+    def after_fetch(self, event, rows, seconds):
+        with self.lock:
+            entry = self.__entry__(event.query_base)
+            entry['rows'] += rows
+            entry['fetch_time'] += seconds
+
+    def stats(self):
+        """
+        :return: dict mapping each *query_base* to a dict of its figures
+        """
+        with self.lock:
+            return dict((key, dict(entry, buckets=list(entry['buckets'])))
+                        for key, entry in self.queries.items())
+
+    def slowest(self, n=10, by='execute_time'):
+        """
+        :param int n: number of queries to return
+        :param str by: figure to sort on, e.g. ``'max_execute_time'`` or ``'rows'``
+        :return: list of up to *n* (query_base, figures) tuples, largest first
+        """
+        return sorted(self.stats().items(), key=lambda item: item[1][by], reverse=True)[:n]
+
+    def reset(self):
+        """Drop all figures."""
+        with self.lock:
+            self.queries = {}
@@ -5,15 +5,54 @@ from __future__ import unicode_literals
 from builtins import zip
 from builtins import object
 from simpycity import NotFoundError
-from simpycity.core import FunctionError, meta_query
+from simpycity.core import FunctionError, Function, Query, meta_query
+from simpycity.handle import TypedCursor
 from simpycity import config as g_config
+from future.utils import with_metaclass
+import hashlib
+import importlib
+import inspect
+import json
+import os
+import pkgutil
 import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
 import sys
+import weakref
 
-def d_out(text):
+def d_out(text, *args):
 
     if g_config.debug:
-        print(text)
+        print(text % args if args else text)
+
+def json_dumps(value):
+    """
+    *json.dumps*, writing values json doesn't know, e.g. dates, as strings,
+    for Postgresql to cast back.
+    """
+    return json.dumps(value, default=str)
+
+def tokenize_composite(s):
+    """
+    Faster equivalent of *psycopg2.extras.CompositeCaster.tokenize*: splits
+    the text of a composite value into the text of its attributes, ``None``
+    for nulls. Values without quoted attributes are split directly.
+    """
+    if '"' not in s:
+        return [token or None for token in s[1:-1].split(',')]
+    tokens = []
+    undouble = psycopg2.extras.CompositeCaster._re_undouble
+    for null, quoted, unquoted in psycopg2.extras.CompositeCaster._re_tokenize.findall(s):
+        if null:
+            tokens.append(None)
+        elif unquoted:
+            tokens.append(unquoted)
+        elif '"' in quoted or '\\' in quoted:
+            tokens.append(undouble.sub(r"\1", quoted))
+        else:
+            tokens.append(quoted)
+    return tokens
 
 class Construct(object):
     config = None
@@ -27,7 +66,7 @@ class Construct(object):
         :param handle: Override global handle, if any
         """
 
-        d_out("Construct.__init__: config=%s, handle=%s" % (config, handle))
+        d_out("Construct.__init__: config=%s, handle=%s", config, handle)
 
         if not self.config:
             self.config = config or g_config
@@ -49,8 +88,13 @@ class Construct(object):
             raise AttributeError("Cannot call commit without localized handle.")
 
     def close(self):
+        """
+        Close the handle, or return it to its pool if it came from *simpycity.pool.HandlePool*.
+        The next reference to *handle* asks *handle_factory* for a new one.
+        """
         if self.init_handle:
             self.init_handle.close()
+            self.init_handle = None
 
     def rollback(self):
         if self.handle is not None:
@@ -59,7 +103,206 @@ class Construct(object):
             raise AttributeError("Cannot call rollback without localized handle.")
 
 
-class SimpleModel(Construct):
+class LazyBatch(object):
+    """
+    The model instances of one result set, so that lazy loading one of
+    them loads its unloaded siblings too. See *SimpleModel.lazyload_all*.
+    """
+
+    def __init__(self):
+        self.members = []
+
+    def add(self, instance):
+        self.members.append(weakref.ref(instance))
+        instance.__store__('_batch', self)
+
+    def pending(self, cls, group=None):
+        """
+        :param str group: a group of *SimpleModel.lazy_groups*, for the members
+            that have not loaded it; ``None`` for those not loaded
+        :return: the members of class *cls* still alive and not loaded
+        """
+        pending = []
+        for ref in self.members:
+            instance = ref()
+            if instance is not None and type(instance) is cls and not instance.__is_loaded__(group):
+                pending.append(instance)
+        return pending
+
+
+class Column(object):
+    """
+    Class attribute standing in for a column of *SimpleModel.table* that has
+    no value on the instance. Loaded columns live in the instance
+    ``__dict__``, which takes precedence, so reading them is plain attribute
+    access.
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self
+        return instance.__missing_column__(self.name)
+
+
+class BoundQuery(object):
+    """
+    A *meta_query* of a *SimpleModel* bound to an instance: arguments not
+    passed are taken from the instance's columns of the same name, and the
+    query runs on the instance's handle. Other attributes are those of the query.
+    """
+
+    def __init__(self, model, query):
+        self.model = model
+        self.query = query
+
+    def __call__(self, *args, **kwargs):
+        if args:
+            raise FunctionError("This function can only take keyword arguments.")
+        model = self.model
+        my_args = kwargs.copy()
+        if g_config.debug:
+            d_out("BoundQuery: kwargs: %r", kwargs)
+            d_out("BoundQuery: model values: %s", model.__values__())
+        for arg in self.query.args:
+            if arg not in kwargs:
+                my_args[arg] = getattr(model, arg, None)
+
+        options = my_args['options'] = dict(kwargs.get('options') or {})
+        # pass the model to the query object
+        options['model'] = model
+        options['handle'] = model.handle
+        rs = self.query(**my_args)
+        d_out("BoundQuery: model: %s query: %s returned %s", model, self.query, rs)
+        return rs
+
+    def __getattr__(self, name):
+        return getattr(self.query, name)
+
+
+class QueryAttribute(object):
+    """
+    Class attribute wrapping a *meta_query* declared on a *SimpleModel*.
+    Read from the class, it is the query itself; read from an instance, a
+    *BoundQuery*, made once per instance and query, or, for a query that
+    *is_property*, the result of calling it.
+    """
+    __slots__ = ('name', 'query')
+
+    def __init__(self, name, query):
+        self.name = name
+        self.query = query
+
+    def __get__(self, instance, owner):
+        if instance is None:
+            return self.query
+        if self.query.is_property:
+            return BoundQuery(instance, self.query)()
+        bound = instance.__raw__('_bound')
+        if bound is None:
+            bound = {}
+            instance.__store__('_bound', bound)
+        try:
+            return bound[self.name]
+        except KeyError:
+            query = bound[self.name] = BoundQuery(instance, self.query)
+            return query
+
+
+class ModelMeta(type):
+    """
+    Metaclass of *SimpleModel*: sets up the *Column* and *QueryAttribute*
+    descriptors when a class is created, and again when its *table* or
+    query attributes are assigned.
+    """
+    unbound = frozenset(['__load__', '__lazyload_many__'])
+    """query attributes used as they are rather than bound to instances"""
+
+    def __init__(cls, name, bases, attrs):
+        super(ModelMeta, cls).__init__(name, bases, attrs)
+        for key, value in list(attrs.items()):
+            if isinstance(value, meta_query) and key not in ModelMeta.unbound:
+                type.__setattr__(cls, key, QueryAttribute(key, value))
+        cls.__columns__()
+
+    def __setattr__(cls, name, value):
+        if isinstance(value, meta_query) and name not in ModelMeta.unbound:
+            value = QueryAttribute(name, value)
+        super(ModelMeta, cls).__setattr__(name, value)
+        if name == 'table':
+            cls.__columns__()
+
+    def __columns__(cls):
+        own = cls.__dict__
+        if 'table' in own:
+            # subclasses without a table of their own inherit it
+            type.__setattr__(cls, 'column_set', frozenset(cls.table))
+        for column in getattr(cls, 'table', ()):
+            if not cls.__shadows__(column):
+                type.__setattr__(cls, column, Column(column))
+
+    def __shadows__(cls, column):
+        """
+        :return: whether an attribute for *column* would shadow a method or
+            attribute, such as *handle* or *save*, defined by the class or
+            its bases; such columns are only read through *as_dict*
+        """
+        current = next((base.__dict__[column] for base in cls.__mro__
+                        if base is not object and column in base.__dict__), None)
+        return current is not None and not isinstance(current, Column)
+
+
+class CompactModel(object):
+    """
+    Mixed into the classes made by *SimpleModel.compact_class*: column values
+    and internal state are stored in ``__slots__`` instead of an instance
+    ``__dict__``, which is never created unless other attributes are set.
+    """
+    __slots__ = ()
+
+    internal_slots = ('_loaded', '_groups', '_changed', '_batch', '_mapped', '_bound', 'config', 'init_handle')
+    """slots for the state *SimpleModel* and *Construct* keep on instances"""
+
+    def __getattr__(self, name):
+        # only called for unset slots and missing attributes
+        cls = type(self)
+        if name in cls.column_set:
+            return self.__missing_column__(name)
+        if name in CompactModel.internal_slots:
+            return getattr(cls.model_class, name, None)
+        raise AttributeError(name)
+
+    def __raw__(self, name):
+        slot = type(self).slot_map.get(name)
+        if slot is None:
+            return super(CompactModel, self).__raw__(name)
+        try:
+            return slot.__get__(self, type(self))
+        except AttributeError:
+            return None
+
+    def __store__(self, name, value):
+        slot = type(self).slot_map.get(name)
+        if slot is None:
+            # a column without a slot, as it would shadow a method
+            self.__dict__[name] = value
+        else:
+            slot.__set__(self, value)
+
+    def __update__(self, values):
+        slot_map = type(self).slot_map
+        for name, value in values.items():
+            slot = slot_map.get(name)
+            if slot is None:
+                self.__dict__[name] = value
+            else:
+                slot.__set__(self, value)
+
+
+class SimpleModel(with_metaclass(ModelMeta, Construct)):
 
     """
     The basic simple model class.
@@ -69,6 +312,19 @@ class SimpleModel(Construct):
     * __load__ to be a *FunctionSingle* or *QuerySingle* that loads an instance, based on primary key, from the database.
     * __lazyload__ to be a *FunctionSingle* that loads an instance from the database, depending on the existance of a value for
       *loaded_indicator*, which should be a member of *table* that will only be populated after the instance is fully loaded.
+
+    A model with a single column *primary_key* may also declare *__lazyload_many__*, a query
+    taking an array of primary keys and returning the rows for them. Lazy loading
+    one instance of a result set then loads all unloaded instances of the result set
+    with one call; see *lazyload_all*.
+
+    Columns too costly to load with the others can be declared in *lazy_groups*:
+    lazy loading leaves them out, and each group is lazy loaded on its own,
+    when one of its columns is read.
+
+    Columns assigned with *set* or as attributes are recorded, see *changes*,
+    so that *save* can skip unchanged instances, or pass only the changes to
+    *__save_partial__*.
     """
 
     pg_type = None
@@ -80,6 +336,89 @@ class SimpleModel(Construct):
     """
     Declare a list of columns to become class attributes. Or leave empty, and define *pg_type*.
     """
+    lazy_groups = None
+    """
+    dict mapping group names to lists of columns, e.g. ``{'body': ['html', 'raw']}``,
+    lazy loaded with *__lazyload__* or *__lazyload_many__* only when one of them is read.
+    The loaders are called with the *columns* option, so they must not be typed queries,
+    or they load all the columns at once.
+    """
+    lazyload_batch_size = 1000
+    """maximum number of keys passed to one call of *__lazyload_many__*"""
+    primary_key = None
+    """
+    Column name, or list of column names, identifying an instance. When set, and the
+    handle keeps an identity map (see *simpycity.handle.Handle.enable_identity_map*),
+    constructing an instance already loaded in the current transaction, by primary key
+    and with that handle, returns the loaded instance, and composite values of an
+    already loaded row are returned as the loaded instance, with the columns it
+    lacked filled in. Only instances loaded by *__load__* or decoded from a
+    composite value are mapped.
+    """
+
+    def __new__(cls, *args, **kwargs):
+        handle = kwargs.get('handle')
+        identity_map = getattr(handle, 'identity_map', None)
+        if identity_map:
+            key = cls.__lookup_key__(args, kwargs)
+            if key is not None:
+                instance = identity_map.get((cls, key))
+                if instance is not None:
+                    d_out("SimpleModel.__new__: %r %s found in identity map", cls, key)
+                    return instance
+        return super(SimpleModel, cls).__new__(cls)
+
+    @classmethod
+    def identity_key(cls, args, kwargs):
+        """
+        :return: tuple of the *primary_key* values given by constructor
+            arguments *args* and *kwargs*, or ``None`` if they don't give them all
+        """
+        names = cls.primary_key
+        if names is None:
+            return None
+        if not isinstance(names, (list, tuple)):
+            names = (names,)
+        if args:
+            if len(args) != len(names):
+                return None
+            key = tuple(args)
+        else:
+            try:
+                key = tuple(kwargs[name] for name in names)
+            except KeyError:
+                return None
+        if None in key:
+            return None
+        return key
+
+    @classmethod
+    def __lookup_key__(cls, args, kwargs):
+        """
+        Private method.
+        :return: the *identity_key* of the instance constructor arguments *args*
+            and *kwargs* ask for, if they give the *primary_key* and nothing else:
+            as keyword arguments, or as positional arguments to a *__load__*
+            taking the *primary_key* columns; else ``None``
+        """
+        names = cls.primary_key
+        if names is None:
+            return None
+        if not isinstance(names, (list, tuple)):
+            names = [names]
+        given = set(kwargs) - set(['handle', 'config', 'options'])
+        if args:
+            load = getattr(cls, '__load__', None)
+            if given or load is None or list(load.args) != list(names):
+                return None
+        elif given != set(names):
+            return None
+        return cls.identity_key(args, kwargs)
+
+    @classmethod
+    def __remember__(cls, identity_map, instance, key):
+        identity_map[(cls, key)] = instance
+        instance.__store__('_mapped', True)
 
     def __init__(self, *args, **kwargs):
         """
@@ -87,6 +426,9 @@ class SimpleModel(Construct):
         Tests for the presence of a primary key, and attempts to load a
         description using it.
         """
+        if self.__raw__('_mapped') and (self.__is_loaded__() or not hasattr(self, '__load__')):
+            # returned from the identity map by __new__: already set up
+            return
 
         if 'config' in kwargs:
             config = kwargs['config']
@@ -100,9 +442,9 @@ class SimpleModel(Construct):
         else:
             handle = None
 
-        if args or kwargs:
-            d_out("SimpleModel.__init__: Got args of %s" % repr(args))
-            d_out("SimpleModel.__init__: Got kwargs of %s" % repr(kwargs))
+        if g_config.debug and (args or kwargs):
+            d_out("SimpleModel.__init__: Got args of %r", args)
+            d_out("SimpleModel.__init__: Got kwargs of %r", kwargs)
 
         #
         # If the type defines a base type, the base instance will be
@@ -114,17 +456,21 @@ class SimpleModel(Construct):
         #
         # Initialize table attrs by copying from keyword arguments.
         #
-        # This makes sure the objects not loaded from DB has at least
-        # the None values in attrs and access to them doesn't raise.
+        # Columns without a value are left out: reading them goes to
+        # the class's Column descriptor, which returns None or lazy
+        # loads the instance.
         #
-        if hasattr(self, 'table'):
-            for name in self.table:
-                self.__dict__[name] = kwargs.get(name, None)
+        attrs = {}
+        for name in self.table:
+            value = kwargs.get(name)
+            if value is not None:
+                attrs[name] = value
+        self.__update__(attrs)
 
         # should automatically pick up config= and handle=
         super(SimpleModel, self).__init__(config, handle, *args, **kwargs)
 
-        if hasattr(self, 'loaded_indicator') and self.__dict__.get(object.__getattribute__(self, 'loaded_indicator')) is not None:
+        if hasattr(self, 'loaded_indicator') and self.__raw__(self.loaded_indicator) is not None:
             self._loaded = True
         else:
             self._loaded = False
@@ -134,6 +480,63 @@ class SimpleModel(Construct):
             if args or kwargs:
                 self.__load_by_key__(*args, **kwargs)
 
+                # only instances loaded from the database are mapped
+                identity_map = getattr(handle, 'identity_map', None)
+                if identity_map is not None:
+                    key = self.identity_key((), self.__values__())
+                    if key is not None:
+                        self.__remember__(identity_map, self, key)
+
+
+    @classmethod
+    def __from_composite__(cls, attrs):
+        """
+        Private method.
+        Called by the casters of *register_composite* to make an instance from
+        the dict *attrs* of a decoded composite value: sets the columns
+        directly, as *__init__* would, without running it. Classes overriding
+        *__init__*, and classes that would load the instance on construction,
+        go through *__init__*.
+        """
+        if 'base_' in attrs:
+            SimpleModel.merge_base_attrs(attrs)
+        indicator = getattr(cls, 'loaded_indicator', None)
+        loaded = indicator is not None and attrs.get(indicator) is not None
+        if not loaded and hasattr(cls, '__load__'):
+            return cls(**attrs)
+        if getattr(cls.__init__, '__func__', cls.__init__) is not SimpleModel.__dict__['__init__']:
+            instance = cls(**attrs)
+            # the values come from the database
+            instance.__store__('_changed', frozenset())
+            return instance
+
+        instance = cls.__new__(cls)
+        values = {'_loaded': loaded, '_changed': frozenset(), 'init_handle': None}
+        if not instance.config:
+            values['config'] = g_config
+        for name in cls.table:
+            value = attrs.get(name)
+            if value is not None:
+                values[name] = value
+        instance.__update__(values)
+        return instance
+
+    def __merge__(self, attrs):
+        """
+        Private method.
+        Gives the columns without a value their value in *attrs*, the row of
+        this instance decoded again, e.g. by a lazy load through the identity map.
+        """
+        values = {}
+        for name in self.table:
+            value = attrs.get(name)
+            if value is not None and self.__raw__(name) is None:
+                values[name] = value
+        if values:
+            self.__update__(values)
+        indicator = getattr(type(self), 'loaded_indicator', None)
+        if indicator is not None and attrs.get(indicator) is not None:
+            self.__set_loaded__()
 
     def __load_by_key__(self, *args, **kwargs):
         """
@@ -157,116 +560,309 @@ class SimpleModel(Construct):
         try:
             row = self.__load__(*args, **kwargs)
         except psycopg2.InternalError as e:
-            d_out("pgerror=%s pgcode=%s diag=%s" % (e.pgerror, e.pgcode, e.diag))
+            d_out("pgerror=%s pgcode=%s diag=%s", e.pgerror, e.pgcode, e.diag)
             if not (e.pgcode == 'P0002'): # no_data_found
                 raise # as InternalError
 
         if row is None:
             raise NotFoundError()
 
-        d_out("SimpleModel.__load_by_key__: rs: %s" % row)
-        if isinstance(row, psycopg2.extras.DictRow):
-            loaded_attrs = dict(row)
-        elif isinstance(row, SimpleModel):
-            #python 2.7+:
-            #loaded_attrs = {_ for _ in rs.__dict__.iteritems() if _[0] in self.table}
-            loaded_attrs = {}
-            for col in self.table:
-                loaded_attrs[col] = row.__dict__[col]
-        else:
-            raise Exception("row is type {0}".format(type(row)))
-        SimpleModel.merge_base_attrs(loaded_attrs)
+        d_out("SimpleModel.__load_by_key__: rs: %s", row)
+        loaded_attrs = self.row_attrs(row)
+        values = {}
         for item in self.table:
-            d_out("SimpleModel.__load_by_key__: %s during load is %s" % (item, repr(loaded_attrs[item])))
-            self.__dict__[item] = loaded_attrs[item]
+            d_out("SimpleModel.__load_by_key__: %s during load is %r", item, loaded_attrs[item])
+            values[item] = loaded_attrs[item]
+        self.__update__(values)
         self._loaded = True
-        d_out("SimpleModel.__load_by_key__: self.__dict__ is %s" % self.__dict__)
+        self._changed = frozenset()
+        if g_config.debug:
+            d_out("SimpleModel.__load_by_key__: values are %s", self.__values__())
 
-    def __getattribute__(self,name):
+    def __missing_column__(self, name):
+        """
+        Private method.
+        Called by *Column* when column *name* has no value on the instance:
+        lazy loads the instance, or the group of *lazy_groups* the column is in,
+        if it can, see *__lazyload__* and *lazyload_all*.
+        :return: the column value
+        """
+        cls = type(self)
+        group = cls.__column_group__(name)
+        if self.__is_loaded__(group):
+            return self.__raw__(name)
+        many = hasattr(cls, '__lazyload_many__')
+        if not many and not hasattr(cls, '__lazyload__'):
+            return None
+
+        d_out("lazyloading %s on %s", cls, name)
+        batch = self.__raw__('_batch')
+        if many and (batch or not hasattr(cls, '__lazyload__')):
+            cls.lazyload_all(batch.pending(cls, group) if batch else [self], handle=self.handle, group=group)
+            if not self.__is_loaded__(group):
+                raise NotFoundError("__lazyload_many__ returned no row for {0}".format(
+                    self.identity_key((), self.__values__())))
+            return self.__raw__(name)
+
+        loader = self.__lazyload__
+        columns, groups = cls.__lazy_plan__(loader, group)
+        for loaded in groups:
+            self.__set_loaded__(loaded)
+        options = {'handle': self.handle}
+        if columns is not None:
+            options['columns'] = columns
+        rs = loader(options=options)
+        if not rs:
+            raise NotFoundError("__lazyload__ returned: {0}".format(rs))
+        self.__update__(cls.__lazy_attrs__(self.row_attrs(rs), groups))
+        return self.__raw__(name)
 
+    @classmethod
+    def __column_group__(cls, name):
         """
         Private method.
+        :return: the group of *lazy_groups* column *name* is in, or ``None``
+        """
+        if cls.lazy_groups:
+            for group, columns in cls.lazy_groups.items():
+                if name in columns:
+                    return group
+        return None
 
-        This function tests all attributes of the *SimpleModel* if they are
-        instances of *meta_query*.
-        If they are a *meta_query*, columns from the Model are mapped
-        to the InstanceMethods' arguments, as appropriate.
+    @classmethod
+    def __lazy_columns__(cls, group):
         """
+        Private method.
+        :return: the columns of *group* in *lazy_groups*, or, for ``None``, the columns in no group
+        """
+        if group is not None:
+            return list(cls.lazy_groups[group])
+        grouped = set()
+        for columns in (cls.lazy_groups or {}).values():
+            grouped.update(columns)
+        return [name for name in cls.table if name not in grouped]
 
-        attr = object.__getattribute__(self,name)
-        if name == '__load__':
-            d_out("skipping: %s" % name)
-            return attr
+    @classmethod
+    def __lazy_plan__(cls, loader, group):
+        """
+        Private method.
+        :return: tuple of the columns to have *loader* return to load *group*,
+            ``None`` for all, and of the groups they load, ``None`` standing for
+            the columns in no group
+        """
+        if not cls.lazy_groups:
+            return None, [None]
+        query = getattr(loader, 'query', loader)  # unwrap a BoundQuery
+        if (issubclass(loader.cursor_factory, TypedCursor) or getattr(loader, 'direct', False)
+                or not isinstance(query, (Function, Query))):
+            # typed rows, direct calls and raw sql can't be limited to some columns
+            return None, [None] + list(cls.lazy_groups)
+        return cls.__lazy_columns__(group), [group]
 
-        if attr is None and name in object.__getattribute__(self, 'table') and not object.__getattribute__(self,'_loaded'):
-            should_lazyload = hasattr(self,'__lazyload__')
-        else:
-            should_lazyload = False
-
-        if should_lazyload:
-            d_out("lazyloading {0} on {1}".format(self.__class__, name))
-            attrs = object.__getattribute__(self, '__dict__')
-            attrs['_loaded'] = True
-            rs = self.__lazyload__(options={'handle':self.handle})
-            if not rs:
-                raise NotFoundError("__lazyload__ returned: {0}".format(rs))
-            if isinstance(rs, psycopg2.extras.DictRow):
-                loaded_attrs = dict(rs)
-            elif isinstance(rs, SimpleModel):
-                #python 2.7+:
-                #loaded_attrs = {_ for _ in rs.__dict__.iteritems() if _[0] in self.table}
-                loaded_attrs = {}
-                for col in self.table:
-                    loaded_attrs[col] = rs.__dict__[col]
-            else:
-                raise Exception("__lazyload__ returned unexpected type: {0}".format(type(rs)))
-            SimpleModel.merge_base_attrs(loaded_attrs)
-            attrs.update(loaded_attrs)
-            return attrs[name]
-
-        if isinstance(attr, meta_query):
-
-            d_out("SimpleModel.__getattribute__: Found meta_query %s" % name)
-            def instance(*args,**kwargs):
-
-                if args:
-                    raise FunctionError("This function can only take keyword arguments.")
-                my_args = kwargs.copy()
-                d_out("SimpleModel.__getattribute__ InstanceMethod: kwargs: %s" % repr(kwargs))
-                d_out("SimpleModel.__getattribute__ InstanceMethod: self.__dict__: %s" % self.__dict__)
-                for arg in attr.args:
-                    d_out("SimpleModel.__getattribute__ InstanceMethod: checking arg %s" % arg)
-                    if arg not in kwargs:
-                        d_out("not in my_args")
-                        if hasattr(self, arg):
-                            d_out("SimpleModel.__getattribute__ InstanceMethod: found %s in col.." % arg)
-                            my_args[arg] = getattr(self, arg)
-                        else:
-                            my_args[arg] = None
-
-                if 'options' not in kwargs:
-                    d_out("SimpleModel.__getattribute__ InstanceMethod: Didn't find options.")
-                    my_args['options'] = {}
-
-                # pass self to the query object
-                my_args['options']['model'] = self
-
-                d_out("SimpleModel.__getattribute__: InstanceMethod: Setting handle.")
-                my_args['options']['handle'] = self.handle
-                rs = attr(*args, **my_args)
-                d_out("SimpleModel.__getattribute__: InstanceMethod: model :{model} attrib name: {name} (attrib value: {value}) constructor returned {rs}".format(model=self, name=name, value=attr, rs=rs))
-                return rs
-
-            if attr.is_property:
-                return instance()
-            else:
-                return instance
+    @classmethod
+    def __lazy_attrs__(cls, attrs, groups):
+        """
+        Private method.
+        :return: the values of the loaded row *attrs* for the columns of *groups*
+        """
+        if not cls.lazy_groups:
+            return attrs
+        columns = set()
+        for group in groups:
+            columns.update(cls.__lazy_columns__(group))
+        return dict((name, value) for name, value in attrs.items() if name in columns)
+
+    def __is_loaded__(self, group=None):
+        """
+        Private method.
+        :return: whether the group of *lazy_groups*, or for ``None`` the instance, is loaded
+        """
+        if group is None:
+            return bool(self.__raw__('_loaded'))
+        return group in (self.__raw__('_groups') or ())
 
+    def __set_loaded__(self, group=None, loaded=True):
+        """
+        Private method.
+        Marks the group of *lazy_groups*, or for ``None`` the instance, as loaded or not.
+        """
+        if group is None:
+            self.__store__('_loaded', loaded)
         else:
-            return attr
+            groups = self.__raw__('_groups') or frozenset()
+            self.__store__('_groups', groups | frozenset([group]) if loaded else groups - frozenset([group]))
 
     def set(self,col,val):
-        self.__dict__[col] = val
+        self.__store__(col, val)
+        self.__changed__(col)
+
+    def __setattr__(self, name, value):
+        super(SimpleModel, self).__setattr__(name, value)
+        if name in type(self).column_set:
+            self.__changed__(name)
+
+    def __changed__(self, name):
+        """
+        Private method.
+        Records that column *name* was assigned, if the instance is tracking changes.
+        """
+        changed = self.__raw__('_changed')
+        if changed is not None and name not in changed:
+            self.__store__('_changed', changed.union((name,)))
+
+    def changes(self):
+        """
+        :return: dict of the columns assigned since the instance was loaded
+            (by *__load__* or as a composite value) or saved, and their values;
+            ``None`` for an instance made from arguments only, which may differ
+            from the database in any column
+        """
+        changed = self.__raw__('_changed')
+        if changed is None:
+            return None
+        return dict((name, self.__raw__(name)) for name in changed)
+
+    @classmethod
+    def compact_class(cls):
+        """
+        :return: a subclass of this class whose instances keep their columns in
+            ``__slots__``, generated from *table* and reused until *table* changes.
+            Instances need a fraction of the memory, and behave the same, except
+            that attributes other than columns still go to an instance ``__dict__``.
+            See *register_composite* to have query results decoded into it.
+        """
+        compact = cls.__dict__.get('_compact_class')
+        if compact is None or compact.column_set != frozenset(cls.table):
+            slots = tuple(name for name in cls.table
+                          if name not in CompactModel.internal_slots and not cls.__shadows__(name))
+            compact = type(cls)(str(cls.__name__ + 'Compact'), (CompactModel, cls), {
+                '__slots__': slots + CompactModel.internal_slots,
+                '__module__': cls.__module__,
+                'model_class': cls,
+                'column_set': frozenset(cls.table),
+            })
+            compact.slot_map = dict((name, compact.__dict__[name]) for name in compact.__slots__)
+            type.__setattr__(cls, '_compact_class', compact)
+        return compact
+
+    def __raw__(self, name):
+        """
+        Private method.
+        :return: the value stored on the instance for *name*, or ``None``: never lazy loads
+        """
+        return self.__dict__.get(name)
+
+    def __store__(self, name, value):
+        """
+        Private method.
+        Store *value* on the instance for *name*.
+        """
+        self.__dict__[name] = value
+
+    def __update__(self, values):
+        """
+        Private method.
+        Store each item of the dict *values* on the instance.
+        """
+        self.__dict__.update(values)
+
+    def __values__(self, names=None):
+        """
+        Private method.
+        :return: dict of the values stored for *names*, by default the columns of *table*
+        """
+        raw = self.__raw__
+        return dict((name, raw(name)) for name in (self.table if names is None else names))
+
+    def as_dict(self):
+        """
+        Instances keep only the columns that have values in their ``__dict__``
+        (or ``__slots__``), so serialize them with this instead.
+
+        :return: dict of every column of *table* and its value, ``None`` for
+            unset columns, without lazy loading
+        """
+        return self.__values__()
+
+    @classmethod
+    def row_attrs(cls, row):
+        """
+        :param row: a row loading an instance: a *psycopg2.extras.DictRow*, a dict,
+            or an instance of a *SimpleModel* mapped on the row's composite type
+        :return: dict of the row's column values, with *base\_* merged
+        """
+        if isinstance(row, psycopg2.extras.DictRow) and len(row) == 1 and isinstance(row[0], SimpleModel):
+            # the single composite column of a direct function call
+            row = row[0]
+        if isinstance(row, psycopg2.extras.DictRow):
+            loaded_attrs = dict(row)
+        elif isinstance(row, dict):
+            loaded_attrs = dict(row)
+        elif isinstance(row, SimpleModel):
+            loaded_attrs = {}
+            for col in cls.table:
+                loaded_attrs[col] = row.__raw__(col)
+        else:
+            raise Exception("row is type {0}".format(type(row)))
+        SimpleModel.merge_base_attrs(loaded_attrs)
+        return loaded_attrs
+
+    @classmethod
+    def lazyload_all(cls, models, handle=None, group=None):
+        """
+        Load the unloaded instances among *models*, calling *__lazyload_many__*
+        once per *lazyload_batch_size* instances rather than *__lazyload__* once per instance.
+
+        :param list models: instances of this class
+        :param handle: Override the handle of the first instance
+        :param str group: load this group of *lazy_groups* instead of the columns in no group
+        :return: list of the instances no row was returned for; they stay unloaded
+        """
+        names = cls.primary_key
+        if isinstance(names, (list, tuple)):
+            names = names[0] if len(names) == 1 else None
+        if names is None:
+            raise NotImplementedError("__lazyload_many__ needs a single column primary_key.")
+        loader = cls.__lazyload_many__
+        columns, groups = cls.__lazy_plan__(loader, group)
+        options = {}
+        if columns is not None:
+            options['columns'] = columns if names in columns else [names] + columns
+
+        by_key = {}
+        for model in models:
+            if not model.__is_loaded__(group):
+                by_key.setdefault(model.__raw__(names), []).append(model)
+        if not by_key:
+            return []
+        if handle is None:
+            handle = next(iter(by_key.values()))[0].handle
+
+        missing = []
+        keys = list(by_key)
+        for start in range(0, len(keys), cls.lazyload_batch_size):
+            chunk = keys[start:start + cls.lazyload_batch_size]
+            for key in chunk:
+                for model in by_key[key]:
+                    # no recursive lazy loading while the rows are read
+                    for loaded in groups:
+                        model.__set_loaded__(loaded)
+            d_out("SimpleModel.lazyload_all: loading %s %s instances", len(chunk), cls)
+            found = set()
+            for row in loader(chunk, options=dict(options, handle=handle)):
+                loaded_attrs = cls.row_attrs(row)
+                key = loaded_attrs.get(names)
+                loaded_attrs = cls.__lazy_attrs__(loaded_attrs, groups)
+                for model in by_key.get(key, ()):
+                    model.__update__(loaded_attrs)
+                found.add(key)
+            for key in chunk:
+                if key not in found:
+                    for model in by_key[key]:
+                        for loaded in groups:
+                            model.__set_loaded__(loaded, False)
+                        missing.append(model)
+        return missing
 
 
     def save(self):
@@ -277,25 +873,39 @@ class SimpleModel(Construct):
         Performs the __save__ method, if it has been declared.
         If not, this function raises a CannotSave exception.
         .save() does *not* implicitly commit the model.
-        To commit, it must be done manually."""
+        To commit, it must be done manually.
+
+        Nothing is sent for an instance without *changes*. If the instance has
+        some and *__save_partial__* is declared, it is called instead of *__save__*,
+        with its argument *changes* set to the changes as json, and its other
+        arguments, e.g. the primary key, taken from the instance."""
 
-        if hasattr(self, "__save__"):
+        changes = self.changes()
+        if changes is not None and not changes:
+            d_out("SimpleModel.save: %r is unchanged", self)
+            return
 
-            args = self.__save__.args()
+        if changes and hasattr(self, "__save_partial__"):
+            self.__save_partial__(changes=psycopg2.extras.Json(changes, dumps=json_dumps))
+            self.__store__('_changed', frozenset())
+        elif hasattr(self, "__save__"):
+
+            args = self.__save__.args
             my_args = {}
             for arg in args:
-                my_args[arg] = self.__dict__.get(arg, None)
+                my_args[arg] = self.__raw__(arg)
             rs = self.__save__(**my_args).fetchone()
 
             for arg in self.table:
                 if arg in rs:
-                    self.__dict__[arg] = rs[arg]
+                    self.__store__(arg, rs[arg])
+            self.__store__('_changed', frozenset())
         else:
 #            from simpycity import CannotSave
             raise NotImplementedError("Cannot save without __save__ declaration.")
 
     @classmethod
-    def register_composite(cls, name, handle=None, factory=None):
+    def register_composite(cls, name, handle=None, factory=None, compact=False):
         """
         Maps a Postgresql type to this class.  If the class's *table* attribute
         is empty, and the class has an attribute *pg_type* of tuple (schema, type),
@@ -313,54 +923,106 @@ class SimpleModel(Construct):
         :param simpycity.handle.Handle handle:
         :param psycopg2.extras.CompositeCaster factory: use
             it to customize how to cast composite types
+        :param boolean compact: decode values into instances of *compact_class*
         :return: the registered *CompositeCaster* instance
             responsible for the conversion
         """
+        return register_composites([(cls, name)], handle, factory=factory, compact=compact)[0]
+
+    @classmethod
+    def __caster_factory__(cls):
+        """
+        Private method.
+        :return: a *psycopg2.extras.CompositeCaster* subclass decoding values into instances of this class
+        """
+        batched = hasattr(cls, '__lazyload_many__')
+
         class CustomCompositeCaster(psycopg2.extras.CompositeCaster):
 
             def make(self, values):
-                d_out("CustomCompositeCaster.make: cls={0} values={1}".format(repr(cls), repr(values)))
-                return cls(**dict(list(zip(self.attnames, values))))
+                return cls.__from_composite__(dict(zip(self.attnames, values)))
+
+            def tokenize(self, s):
+                return tokenize_composite(s)
+
+            def parse(self, s, curs):
+                identity_map = getattr(curs.connection, 'identity_map', None)
+                if identity_map is None or cls.primary_key is None or s is None:
+                    instance = super(CustomCompositeCaster, self).parse(s, curs)
+                    if batched and instance is not None:
+                        self.__batch__(curs).add(instance)
+                    return instance
+
+                tokens = self.tokenize(s)
+                if len(tokens) != len(self.atttypes):
+                    raise psycopg2.DataError(
+                        "expecting %d components for the type %s, %d found instead" %
+                        (len(self.atttypes), self.name, len(tokens)))
+                values = [curs.cast(oid, token) for oid, token in zip(self.atttypes, tokens)]
+                attrs = dict(zip(self.attnames, values))
+                key_attrs = dict(attrs)
+                SimpleModel.merge_base_attrs(key_attrs)
+                key = cls.identity_key((), key_attrs)
+                if key is not None:
+                    instance = identity_map.get((cls, key))
+                    if instance is not None:
+                        # e.g. decoded again by a lazy load of the instance
+                        instance.__merge__(key_attrs)
+                        return instance
+                instance = cls.__from_composite__(attrs)
+                if key is not None:
+                    cls.__remember__(identity_map, instance, key)
+                if batched:
+                    self.__batch__(curs).add(instance)
+                return instance
 
-        PG_TYPE_SQL = """SELECT array_agg(attname)
-FROM
-    (
-        SELECT attname
-        FROM
-            pg_type t
-            JOIN pg_namespace ns ON typnamespace = ns.oid
-            JOIN pg_attribute a ON attrelid = typrelid
-        WHERE nspname = %s AND typname = %s
-            AND attnum > 0 AND NOT attisdropped
-        ORDER BY attnum
-    ) sub;"""
-        if handle is None:
-            handle = g_config.handle_factory()
-        d_out("SimpleModel.register_composite: before: table for {0} is {1}".format(repr(cls.pg_type), cls.table))
+            def __batch__(self, curs):
+                # one batch per result set: kept on the cursor, when it takes attributes
+                batches = getattr(curs, 'lazy_batches', None)
+                if batches is None:
+                    batches = {}
+                    try:
+                        curs.lazy_batches = batches
+                    except AttributeError:
+                        pass
+                return batches.setdefault(cls, LazyBatch())
+
+        return CustomCompositeCaster
+
+    @classmethod
+    def __register__(cls, metadata, name, factory, compact):
+        """
+        Private method.
+        Registers a caster for the type *name* globally, from the
+        *composite_metadata* *metadata*, computing *table* from *pg_type*
+        first, if needed. See *register_composite* for *factory* and *compact*.
+        :return: the registered caster
+        """
+        d_out("SimpleModel.register_composite: before: table for %r is %s", cls.pg_type, cls.table)
         if cls.pg_type is not None:
             super_table = cls.__mro__[1].table if hasattr(cls.__mro__[1], 'table') else []
             if cls.table == [] or cls.table is super_table:
-                cursor = handle.cursor()
-                cursor.execute(PG_TYPE_SQL, cls.pg_type)
-                row = cursor.fetchone()
-                d_out("SimpleModel.register_composite: row={0}".format(row))
-                row[0] = [_ for _ in row[0] if _ != 'base_']
-                cls.table = cls.table + row[0]
-                d_out("SimpleModel.register_composite: after: table for {0} is {1}".format(repr(cls.pg_type), cls.table))
+                attnames = metadata['.'.join(cls.pg_type)]['attnames']
+                cls.table = cls.table + [_ for _ in attnames if _ != 'base_']
+                d_out("SimpleModel.register_composite: after: table for %r is %s", cls.pg_type, cls.table)
+        if compact:
+            # the casters look cls up when they run
+            cls = cls.compact_class()
         if factory is None:
-            factory = CustomCompositeCaster
-        if sys.version_info[0] < 3:
-            name = str(name)
-        return psycopg2.extras.register_composite(
-            name,
-            handle.conn,
-            globally=True,  # in case of reconnects
-            factory=factory
-        )
+            factory = cls.__caster_factory__()
+
+        info = metadata[name]
+        caster = factory(str(info['name']), info['oid'], list(zip(info['attnames'], info['atttypes'])),
+                         array_oid=info['array_oid'], schema=info['schema'])
+        # globally, in case of reconnects
+        psycopg2.extensions.register_type(caster.typecaster)
+        if caster.array_typecaster is not None:
+            psycopg2.extensions.register_type(caster.array_typecaster)
+        return caster
 
     @staticmethod
     def merge_base_attrs(attrs):
-        """
+        r"""
         :param dict attrs: If one of the attrs is named "base\_", assume that attribute is an instance of SimpleModel mapped on a Postgresql composite type, and that the base\_ instance is of a superclass of this class. Expand the attributes of the base\_ type and assign to class attributes.
 
         psycopg2's type casting uses namedtuple() and that forbids a
@@ -368,6 +1030,214 @@ FROM
         """
         base = attrs.pop('base_', None)
         if base:
-            d_out("SimpleModel.merge_base_attrs: base.table={0}".format(base.table))
+            d_out("SimpleModel.merge_base_attrs: base.table=%s", base.table)
             for name in base.table:
-                attrs[name] = base.__dict__[name]
+                attrs[name] = base.__raw__(name)
+
+
+COMPOSITE_SQL = """SELECT r.name, t.oid, t.typarray, nspname, typname,
+    array_agg(attname::text ORDER BY attnum), array_agg(atttypid::int8 ORDER BY attnum)
+FROM
+    unnest(%s::text[], %s::text[], %s::text[]) r(name, schema, type)
+    JOIN pg_type t ON t.oid = coalesce(
+        (
+            SELECT pt.oid
+            FROM
+                pg_type pt
+                JOIN pg_namespace pns ON pt.typnamespace = pns.oid
+            WHERE pns.nspname = r.schema AND pt.typname = r.type
+        ),
+        to_regtype(r.name))
+    JOIN pg_namespace ns ON typnamespace = ns.oid
+    JOIN pg_attribute a ON attrelid = typrelid
+WHERE attnum > 0 AND NOT attisdropped
+GROUP BY r.name, t.oid, t.typarray, nspname, typname;"""
+
+
+def composite_metadata(handle, names):
+    """
+    Looks up composite types in the catalog, all in one query. As with
+    *psycopg2.extras.register_composite*, a name without a schema is looked
+    up in ``public``, then in the search path, which needs PostgreSQL 9.4 or
+    later (for ``to_regtype``).
+
+    :param simpycity.handle.Handle handle:
+    :param list names: type names, e.g. ``'public.test_table'``
+    :return: dict mapping each name to a dict of the type's *oid*, *array_oid*,
+        *schema*, *name*, *attnames* and *atttypes*
+    :raise psycopg2.ProgrammingError: if a type is not found
+    """
+    names = sorted(set(names))
+    schemas, types = [], []
+    for name in names:
+        schema, type_name = name.split('.', 1) if '.' in name else ('public', name)
+        schemas.append(schema)
+        types.append(type_name)
+
+    cursor = handle.cursor()
+    status = handle.conn.status
+    cursor.execute(COMPOSITE_SQL, [names, schemas, types])
+    rows = cursor.fetchall()
+    # leave the connection as it was, like psycopg2 does
+    if status != psycopg2.extensions.STATUS_IN_TRANSACTION and not handle.conn.autocommit:
+        handle.conn.rollback()
+
+    metadata = {}
+    for name, oid, array_oid, schema, type_name, attnames, atttypes in rows:
+        metadata[name] = {'oid': oid, 'array_oid': array_oid, 'schema': schema,
+                          'name': type_name, 'attnames': attnames, 'atttypes': atttypes}
+    for name in names:
+        if name not in metadata:
+            raise psycopg2.ProgrammingError("PostgreSQL type '{0}' not found".format(name))
+    d_out("composite_metadata: loaded %s types", len(metadata))
+    return metadata
+
+
+def database_key(dsn):
+    """
+    :param str dsn: a libpq connection string
+    :return: a digest identifying the database *dsn* connects to, along with
+        the libpq environment variables that can choose it, without giving
+        away the password
+    """
+    env = ['{0}={1}'.format(name, os.environ.get(name, ''))
+           for name in ('PGHOST', 'PGHOSTADDR', 'PGPORT', 'PGDATABASE', 'PGUSER', 'PGSERVICE')]
+    return hashlib.sha1('\n'.join([dsn] + env).encode('utf-8')).hexdigest()
+
+
+def load_composite_metadata(path, version, names, database=None):
+    """
+    :return: the *composite_metadata* saved by *save_composite_metadata* in
+        the file *path*, if it was saved for the schema *version* and the
+        *database_key* *database*, and has all the types *names*, else ``None``
+    """
+    try:
+        with open(path) as f:
+            saved = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if saved.get('version') != version:
+        d_out("load_composite_metadata: %s is for schema version %r", path, saved.get('version'))
+        return None
+    if saved.get('database') != database:
+        d_out("load_composite_metadata: %s is for another database", path)
+        return None
+    metadata = saved.get('types', {})
+    if not all(name in metadata for name in names):
+        return None
+    return metadata
+
+
+def save_composite_metadata(path, version, metadata, database=None):
+    """
+    Saves *composite_metadata* to the file *path*, with the types already
+    saved there for the same schema *version* and *database_key* *database*.
+    The file is replaced atomically, so processes starting at the same time can share it.
+    """
+    saved = load_composite_metadata(path, version, [], database) or {}
+    saved.update(metadata)
+    temp = '{0}.{1}'.format(path, os.getpid())
+    with open(temp, 'w') as f:
+        json.dump({'version': version, 'database': database, 'types': saved}, f)
+    getattr(os, 'replace', os.rename)(temp, path)
+
+
+def register_composites(models, handle=None, factory=None, compact=False, cache_file=None, schema_version=None):
+    """
+    Maps Postgresql types to classes, as *SimpleModel.register_composite*
+    does, getting the metadata of all the types in a single catalog query,
+    or none at all when it is found in the *cache_file*.
+
+    :param models: (class, type name) pairs, with base classes before the classes inheriting them
+    :param simpycity.handle.Handle handle:
+    :param psycopg2.extras.CompositeCaster factory: for all the types, see *SimpleModel.register_composite*
+    :param boolean compact: decode values into instances of *SimpleModel.compact_class*
+    :param str cache_file: path of a file keeping the metadata between processes;
+        defaults to *simpycity.config.composite_cache*. It is only used for the
+        database it was written for, as told by the DSN of *handle* (or of
+        *simpycity.config*) and the libpq environment variables.
+    :param str schema_version: identifies the database schema the cache file
+        was written for; defaults to *simpycity.config.schema_version*.
+        The cache file is only used with a version.
+    :return: list of the registered *CompositeCaster* instances
+    """
+    models = list(models)
+    names = []
+    for cls, name in models:
+        names.append(name)
+        if cls.pg_type is not None:
+            names.append('.'.join(cls.pg_type))
+    if cache_file is None:
+        cache_file = g_config.composite_cache
+    if schema_version is None:
+        schema_version = g_config.schema_version
+    cached = cache_file is not None and schema_version is not None
+
+    metadata = None
+    if cached:
+        database = database_key(getattr(handle, 'dsn', None) or g_config.dsn())
+        metadata = load_composite_metadata(cache_file, schema_version, names, database)
+    if metadata is None:
+        if handle is None:
+            handle = g_config.handle_factory()
+        metadata = composite_metadata(handle, names)
+        if cached:
+            save_composite_metadata(cache_file, schema_version, metadata, database)
+    return [cls.__register__(metadata, name, factory, compact) for cls, name in models]
+
+
+def register_all(modules_or_classes, handle=None, compact=False, cache_file=None, schema_version=None):
+    """
+    Registers the composite types of many *SimpleModel* subclasses at once,
+    with *register_composites*: each class declaring its own *pg_type* (not
+    one inherited from its base class) is mapped to it, after
+    the classes it inherits from, so that a type extending another one
+    through a ``base_`` attribute gets the columns of its base class first.
+
+    :param modules_or_classes: classes, and modules (or their names) to look
+        for the classes defined in; packages are searched with their submodules
+    :param simpycity.handle.Handle handle:
+    :param boolean compact: see *register_composites*
+    :param str cache_file: see *register_composites*
+    :param str schema_version: see *register_composites*
+    :return: list of the registered classes, in registration order
+    """
+    found = []
+    for item in modules_or_classes:
+        if inspect.isclass(item):
+            found.append(item)
+        else:
+            found.extend(model_classes(item))
+
+    classes = []
+    for cls in found:
+        if cls.__dict__.get('pg_type') is not None and cls not in classes and not issubclass(cls, CompactModel):
+            classes.append(cls)
+    # a base class has a shorter MRO than the classes inheriting from it;
+    # the sort is stable, so unrelated classes keep their order
+    classes.sort(key=lambda cls: len(cls.__mro__))
+    d_out("register_all: registering %s", classes)
+    register_composites([(cls, '.'.join(cls.pg_type)) for cls in classes], handle,
+                        compact=compact, cache_file=cache_file, schema_version=schema_version)
+    return classes
+
+
+def model_classes(module):
+    """
+    :param module: a module or module name; for a package, its submodules are imported and searched too
+    :return: list of the *SimpleModel* subclasses defined in *module*
+    """
+    if not inspect.ismodule(module):
+        module = importlib.import_module(module)
+    modules = [module]
+    if hasattr(module, '__path__'):
+        for _, name, _ in pkgutil.walk_packages(module.__path__, module.__name__ + '.'):
+            modules.append(importlib.import_module(name))
+
+    classes = []
+    for module in modules:
+        for value in vars(module).values():
+            if inspect.isclass(value) and issubclass(value, SimpleModel) and \
+                    value.__module__ == module.__name__:
+                classes.append(value)
+    return classes
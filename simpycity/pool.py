@@ -0,0 +1,241 @@
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import range
+from builtins import object
+import threading
+import time
+import psycopg2
+import psycopg2.extensions
+from simpycity import config as g_config, PoolError
+from simpycity.handle import Handle
+
+def d_out(text, *args):
+
+    if g_config.debug:
+        print(text % args if args else text)
+
+
+class PooledHandle(Handle):
+    """
+    A Handle owned by a *HandlePool*.
+    Closing it returns it to the pool; *discard* really closes the connection.
+    """
+
+    def __init__(self, pool, *args, **kwargs):
+        self.pool = pool
+        self.idle_since = None
+        self.checked_out = False
+        super(PooledHandle, self).__init__(*args, **kwargs)
+
+    def close(self, *args, **kwargs):
+        if self.pool is not None:
+            # closing again is a no-op, as for a Handle
+            if self.checked_out:
+                self.pool.checkin(self)
+        else:
+            super(PooledHandle, self).close(*args, **kwargs)
+
+    def discard(self):
+        """
+        Close the connection for good; the handle no longer belongs to a pool.
+        """
+        self.pool = None
+        super(PooledHandle, self).close()
+
+    def __del__(self):
+        d_out("PooledHandle.__del__: destroying handle, de-allocating connection")
+        if self.conn:
+            self.discard()
+
+
+class HandlePool(object):
+    """
+    A thread-safe pool of *PooledHandle* instances.
+    Install it with ``simpycity.config.handle_factory = pool.handle_factory``;
+    every *meta_query* or *Construct* without a handle then checks one out.
+    A *meta_query* call checks its handle back in once the rows are read and
+    the transaction committed; *Construct.close()* checks in the handle of a
+    *Construct*.
+    """
+
+    def __init__(self, minconn=1, maxconn=10, idle_timeout=None, timeout=None,
+                 check_on_checkout=False, dsn=None, config=None, isolation_level=None):
+        """
+        :param int minconn: handles opened up front and never closed for being idle
+        :param int maxconn: maximum number of handles, idle or checked out
+        :param float idle_timeout: seconds after which an idle handle beyond *minconn* is closed; ``None`` keeps them
+        :param float timeout: seconds *checkout* waits for a free handle before raising *simpycity.PoolError*;
+            ``None`` waits forever
+        :param boolean check_on_checkout: run ``SELECT 1`` before handing out an idle handle,
+            replacing it if the connection turns out to be dead
+        :param str dsn: see *simpycity.handle.Handle*
+        :param config: see *simpycity.handle.Handle*
+        :param int isolation_level: see *simpycity.handle.Handle*
+        """
+        if minconn < 0 or maxconn < 1 or minconn > maxconn:
+            raise ValueError("HandlePool needs 0 <= minconn <= maxconn and maxconn >= 1")
+
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.check_on_checkout = check_on_checkout
+        self.handle_args = {'dsn': dsn, 'config': config, 'isolation_level': isolation_level}
+
+        self.closed = False
+        self._idle = []
+        self._used = {}
+        # handles idle, checked out or being connected
+        self._size = 0
+        self._cond = threading.Condition()
+
+        for i in range(minconn):
+            self._size += 1
+            self._release(self._connect())
+
+    def _connect(self):
+        try:
+            return PooledHandle(self, **self.handle_args)
+        except:
+            with self._cond:
+                self._size -= 1
+                self._cond.notify()
+            raise
+
+    def _release(self, handle):
+        handle.idle_since = time.time()
+        self._idle.append(handle)
+
+    def _discard(self, handle):
+        """Call with the lock held."""
+        self._size -= 1
+        handle.discard()
+        self._cond.notify()
+
+    def _prune(self):
+        """Close handles idle longer than *idle_timeout*. Call with the lock held."""
+        if self.idle_timeout is None:
+            return
+        expired = time.time() - self.idle_timeout
+        # the oldest handles sit at the bottom of the idle stack
+        while self._idle and self._size > self.minconn and self._idle[0].idle_since < expired:
+            d_out("HandlePool._prune: closing idle handle")
+            self._discard(self._idle.pop(0))
+
+    def _healthy(self, handle):
+        if handle.conn is None or handle.conn.closed:
+            return False
+        if self.check_on_checkout:
+            try:
+                handle.conn.cursor().execute("SELECT 1")
+                handle.conn.rollback()
+            except psycopg2.Error as e:
+                d_out("HandlePool._healthy: health check failed: %s", e)
+                return False
+        return True
+
+    def checkout(self):
+        """
+        :return: a *PooledHandle*, reused if one is idle, else newly opened if the pool has room
+        :raise simpycity.PoolError: if the pool is closed, or *timeout* expires while the pool is exhausted
+        """
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        while True:
+            handle = None
+            with self._cond:
+                while True:
+                    if self.closed:
+                        raise PoolError("HandlePool is closed.")
+                    self._prune()
+                    if self._idle:
+                        handle = self._idle.pop()
+                        self._used[id(handle)] = handle
+                        handle.checked_out = True
+                        break
+                    if self._size < self.maxconn:
+                        # reserve the slot, then connect without holding the lock
+                        self._size += 1
+                        break
+                    if deadline is None:
+                        self._cond.wait()
+                    else:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise PoolError("HandlePool exhausted: %s handles checked out." % len(self._used))
+                        self._cond.wait(remaining)
+
+            if handle is None:
+                handle = self._connect()
+                with self._cond:
+                    self._used[id(handle)] = handle
+                    handle.checked_out = True
+                return handle
+
+            # check without holding the lock: a round trip mustn't block the pool
+            if self._healthy(handle):
+                return handle
+            d_out("HandlePool.checkout: discarding dead handle")
+            with self._cond:
+                self._used.pop(id(handle), None)
+                handle.checked_out = False
+                self._discard(handle)
+
+    def checkin(self, handle):
+        """
+        Return a checked out handle. An open transaction is rolled back;
+        a handle with a broken connection is closed instead of reused.
+        """
+        with self._cond:
+            if self._used.pop(id(handle), None) is None:
+                raise PoolError("Handle was not checked out from this pool.")
+            handle.checked_out = False
+
+        # roll back without holding the lock: a slow connection mustn't block the pool
+        broken = handle.conn is None or handle.conn.closed
+        if not broken and handle.conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+            try:
+                handle.rollback()
+            except psycopg2.Error as e:
+                d_out("HandlePool.checkin: rollback failed: %s", e)
+                broken = True
+
+        with self._cond:
+            if broken or self.closed or handle.conn.closed:
+                self._discard(handle)
+                return
+
+            self._release(handle)
+            self._prune()
+            self._cond.notify()
+
+    def handle_factory(self, *args, **kwargs):
+        """
+        Drop-in replacement for *simpycity.config.handle_factory*.
+        Arguments are ignored: handles are opened with the pool's own settings.
+
+        :return: instance of *PooledHandle*
+        """
+        return self.checkout()
+
+    def closeall(self):
+        """
+        Close idle handles and refuse further checkouts. Handles still checked
+        out are closed when they are returned.
+        """
+        with self._cond:
+            self.closed = True
+            while self._idle:
+                self._discard(self._idle.pop())
+            self._cond.notify_all()
+
+    @property
+    def size(self):
+        """Number of handles currently open, idle or checked out."""
+        return self._size
+
+    @property
+    def idle(self):
+        """Number of idle handles."""
+        return len(self._idle)
@@ -0,0 +1,229 @@
+"""
+Micro benchmarks for the Python side of Simpycity.
+
+Run with ``python -m simpycity.test.benchmark [name ...]``. Benchmarks that
+don't need a database run against *NullHandle*, so they measure Simpycity's
+own overhead rather than network and server time. The others connect with
+the *simpycity.config* settings (by default, the libpq environment) and
+roll back whatever they create.
+"""
+from __future__ import absolute_import
+from __future__ import division
+from __future__ import print_function
+from __future__ import unicode_literals
+from builtins import object
+from builtins import range
+import gc
+import os
+import shutil
+import sys
+import tempfile
+import timeit
+from simpycity import config, instrument
+from simpycity.core import Function, FunctionTyped
+from simpycity.handle import Handle, Cursor
+from simpycity.model import SimpleModel, register_composites
+
+
+class NullCursor(object):
+    """Accepts any query and returns no rows."""
+    rowcount = 0
+
+    def execute(self, query, vars=None):
+        pass
+
+
+class NullHandle(object):
+    """A handle that never talks to a server, and has no connection."""
+    autocommit = False
+
+    def cursor(self, *args, **kwargs):
+        return NullCursor()
+
+    def prepare(self, query):
+        return query
+
+
+def report(name, number, seconds):
+    print("{0:<40} {1:>10.3f} usec/call".format(name, seconds / number * 1e6))
+
+
+def bench_call(number=100000):
+    """meta_query.__call__ with debugging off: argument binding, query compilation, dispatch."""
+    config.debug = False
+    handle = NullHandle()
+    f = Function('bench', ['a', 'b', 'c'], handle=handle)
+    report('Function() positional', number, timeit.timeit(lambda: f(1, 2, 3), number=number))
+    report('Function() keyword', number, timeit.timeit(lambda: f(a=1, b=2, c=3), number=number))
+    cols = {'columns': ['a', 'b']}
+    report('Function() column limited', number, timeit.timeit(lambda: f(1, 2, 3, options=cols), number=number))
+    names = ['arg{0}'.format(i) for i in range(20)]
+    wide = Function('bench_wide', names, handle=handle)
+    kwargs = dict((name, i) for i, name in enumerate(names))
+    report('Function() 20 keyword arguments', number, timeit.timeit(lambda: wide(**kwargs), number=number))
+    histogram = instrument.Histogram()
+    instrument.register(histogram)
+    try:
+        report('Function() with a Histogram hook', number, timeit.timeit(lambda: f(1, 2, 3), number=number))
+    finally:
+        instrument.unregister(histogram)
+
+
+class BenchRow(SimpleModel):
+    table = ['id', 'value']
+
+
+def bench_typed(rows=100000, repeat=5):
+    """Iterating FunctionTyped results: composite values, and plain integers to isolate cursor overhead."""
+    handle = Handle()
+    handle.execute("CREATE TYPE simpycity_bench_row AS (id int, value text)")
+    handle.execute("""CREATE FUNCTION simpycity_bench_rows(int) RETURNS setof simpycity_bench_row AS
+        $$ SELECT g, 'row ' || g FROM generate_series(1, $1) g $$ LANGUAGE sql""")
+    handle.execute("""CREATE FUNCTION simpycity_bench_ints(int) RETURNS setof int AS
+        $$ SELECT generate_series(1, $1) $$ LANGUAGE sql""")
+    BenchRow.register_composite('simpycity_bench_row', handle)
+
+    for label, function in [('composite', 'simpycity_bench_rows'), ('integer', 'simpycity_bench_ints')]:
+        f = FunctionTyped(function, ['n'], handle=handle)
+
+        def iterate(**options):
+            for value in f(rows, options=options):
+                pass
+
+        def fetchall():
+            f(rows).fetchall()
+
+        def legacy():
+            # the previous TypedCursor: DictRow rows from Cursor, unwrapped one by one
+            cursor = handle.cursor(cursor_factory=Cursor)
+            cursor.execute(f.compile_query('*'), [rows])
+            for row in cursor:
+                row[0]
+
+        def callback():
+            iterate(callback=lambda row: row)
+
+        for name, func in [('DictRow cursor iteration (previous)', legacy),
+                           ('TypedCursor iteration', iterate),
+                           ('TypedCursor iteration with callback', callback),
+                           ('TypedCursor fetchall', fetchall)]:
+            seconds = min(timeit.repeat(func, number=1, repeat=repeat))
+            print("{0:<50} {1:>10.0f} rows/sec".format(label + ': ' + name, rows / seconds))
+    handle.rollback()
+
+
+def bench_composite(number=100000, repeat=5):
+    """Decoding composite values into model instances: the registered caster alone, and arrays fetched from the server."""
+    handle = Handle()
+    handle.execute("CREATE TYPE simpycity_bench_row AS (id int, value text)")
+    caster = BenchRow.register_composite('simpycity_bench_row', handle)
+    cursor = handle.cursor()
+    values = [(i, 'row {0}'.format(i)) for i in range(number)]
+    strings = ['({0},"row {0}")'.format(i) for i in range(number)]
+
+    def make():
+        for value in values:
+            caster.make(value)
+
+    def parse():
+        for string in strings:
+            caster.parse(string, cursor)
+
+    def fetch():
+        cursor.execute("""SELECT array_agg((g, 'row ' || g)::simpycity_bench_row)
+            FROM generate_series(1, %s) g""", [number])
+        cursor.fetchone()
+
+    for name, func in [('caster make()', make), ('caster parse()', parse),
+                       ('fetch one array', fetch)]:
+        seconds = min(timeit.repeat(func, number=1, repeat=repeat))
+        print("{0:<50} {1:>10.0f} composites/sec".format(name, number / seconds))
+    handle.rollback()
+
+
+def bench_register(types=200, repeat=3):
+    """Registering composite types at startup: one by one, in bulk, and from the metadata cache file."""
+    handle = Handle()
+    models = []
+    for i in range(types):
+        handle.execute("CREATE TYPE simpycity_bench_type{0} AS (id int, value text)".format(i))
+        models.append((type(str('BenchType{0}'.format(i)), (SimpleModel,), {'table': ['id', 'value']}),
+                       'simpycity_bench_type{0}'.format(i)))
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'types.json')
+
+    def each():
+        for cls, name in models:
+            cls.register_composite(name, handle)
+
+    def bulk():
+        register_composites(models, handle)
+
+    def cached():
+        register_composites(models, handle, cache_file=path, schema_version=1)
+
+    try:
+        cached()
+        for name, func in [('register_composite() per type', each), ('register_composites()', bulk),
+                           ('register_composites() from cache file', cached)]:
+            seconds = min(timeit.repeat(func, number=1, repeat=repeat))
+            print("{0:<50} {1:>10.1f} msec for {2} types".format(name, seconds * 1e3, types))
+    finally:
+        shutil.rmtree(directory)
+        handle.rollback()
+
+
+class BenchModel(SimpleModel):
+    table = ['id', 'value', 'created', 'flag']
+    get = Function('bench_get', ['id'])
+
+
+def bench_model(number=1000000):
+    """SimpleModel attribute reads: columns, methods and serializing instances to dicts."""
+    model = BenchModel(id=1, value='one', created='2016-01-01', flag=True)
+    report('column read', number, timeit.timeit(lambda: model.value, number=number))
+    empty = BenchModel(id=1)
+    report('unset column read', number, timeit.timeit(lambda: empty.value, number=number))
+    report('query attribute read', number, timeit.timeit(lambda: model.get, number=number))
+    report('plain attribute read', number, timeit.timeit(lambda: model.config, number=number))
+    models = [BenchModel(id=i, value='row', created='2016-01-01', flag=False) for i in range(1000)]
+    table = BenchModel.table
+    rows = number // 1000
+    report('serialize 1000 models to dicts', rows,
+           timeit.timeit(lambda: [dict((name, getattr(m, name)) for name in table) for m in models], number=rows))
+
+
+def bench_memory(number=100000):
+    """Memory held by model instances, regular and from *SimpleModel.compact_class*."""
+    try:
+        import tracemalloc
+    except ImportError:
+        print("memory: needs tracemalloc (Python 3.4+)")
+        return
+    for name, cls in (('model', BenchModel), ('compact model', BenchModel.compact_class())):
+        gc.collect()
+        tracemalloc.start()
+        models = [cls(id=i, value='row', created='2016-01-01', flag=False) for i in range(number)]
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        print("{0:<40} {1:>10.1f} bytes/instance".format(name, size / number))
+        del models
+
+
+BENCHMARKS = {
+    'call': bench_call,
+    'composite': bench_composite,
+    'memory': bench_memory,
+    'model': bench_model,
+    'register': bench_register,
+    'typed': bench_typed,
+}
+
+
+def main(names):
+    for name in names or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -37,6 +37,16 @@ $body$
     SELECT * FROM test_table where id = $1;
 $body$ language sql;
 
+CREATE FUNCTION test_get_many (int[]) RETURNS setof test_table AS
+$body$
+    SELECT * FROM test_table where id = ANY($1);
+$body$ LANGUAGE sql;
+
+CREATE FUNCTION test_partial () RETURNS setof test_table AS
+$body$
+    SELECT id, NULL::text FROM test_table ORDER BY id;
+$body$ LANGUAGE sql;
+
 CREATE FUNCTION test_constant() returns int AS
 $body$
     select 1;
@@ -51,3 +61,9 @@ $body$
     UPDATE test_table SET value =  $2 WHERE id = $1;
     SELECT TRUE;
 $body$ LANGUAGE sql;
+
+CREATE FUNCTION update_partial (int, jsonb) RETURNS boolean AS
+$body$
+    UPDATE test_table SET value = CASE WHEN $2 ? 'value' THEN $2->>'value' ELSE value END WHERE id = $1;
+    SELECT TRUE;
+$body$ LANGUAGE sql;
@@ -1,5 +1,8 @@
+DROP FUNCTION test_get_many(int[]);
+DROP FUNCTION test_partial();
 DROP TYPE nested CASCADE;
 DROP TABLE test_table CASCADE;
 DROP FUNCTION update_row(int, text);
+DROP FUNCTION update_partial(int, jsonb);
 DROP FUNCTION get_value(int);
 DROP FUNCTION test_constant();
@@ -4,13 +4,27 @@ from __future__ import print_function
 from __future__ import unicode_literals
 from future import standard_library
 standard_library.install_aliases()
+from builtins import bytes
+from future.utils import native_str
 import unittest
-from simpycity import config
+from simpycity import config, instrument, NotFoundError, PoolError
 from simpycity.core import *
-from simpycity.model import SimpleModel, Construct
+from simpycity.model import SimpleModel, Construct, BoundQuery, Column, register_composites, register_all
+from simpycity.pool import HandlePool
+from simpycity.cache import ResultCache
 from psycopg2.extensions import cursor as _cursor
 import psycopg2
 import os.path
+import io
+import shutil
+import sys
+import tempfile
+import threading
+import time
+try:
+    import asyncio
+except ImportError as e:
+    asyncio = None
 try:
     import configparser
 except ImportError as e:
@@ -184,6 +198,54 @@ class ModelTest(dbTest):
             "Model value is not 'Test row', got %s" % model.value
         )
 
+    def testCompositeConstruction(self):
+        handle = config.handle_factory()
+        caster = SimpleLazyLoaderModel.register_composite('public.test_table', handle)
+        model = caster.make([1, 'one'])
+        self.assertTrue(model._loaded, "Instance with its loaded_indicator is loaded")
+        self.assertEqual(model.changes(), {}, "Instance from the database tracks changes")
+        model.__dict__.pop('_changed')
+        self.assertEqual(model.__dict__, SimpleLazyLoaderModel(id=1, value='one').__dict__,
+                         "Instance is set up as by __init__")
+        self.assertEqual(caster.make([2, None]).value, 'two', "Partial instance is lazy loaded")
+
+    def testCompositeCustomInit(self):
+        class Labelled(SimpleReturn):
+            def __init__(self, *args, **kwargs):
+                super(Labelled, self).__init__(*args, **kwargs)
+                self.label = 'row {0}'.format(self.id)
+        caster = Labelled.register_composite('public.test_table', config.handle_factory())
+        model = caster.make([1, 'one'])
+        self.assertEqual(model.label, 'row 1', "An overridden __init__ is run")
+        self.assertEqual(model.changes(), {})
+
+    def testAttributes(self):
+        model = SimpleInstanceModel(id=1)
+        self.assertTrue(isinstance(SimpleInstanceModel.get, Function), "Class attribute is the query")
+        self.assertTrue(model.get is model.get, "Bound query is made once per instance")
+        self.assertEqual(model.get.args, ['id'], "Bound query exposes the query's attributes")
+        self.assertEqual((model.id, model.value), (1, None), "Unset columns read as None")
+        self.assertFalse('value' in model.__dict__)
+
+        class Late(SimpleModel):
+            pass
+        Late.table = ['a']
+        Late.q = Function("test_get", ['a'])
+        self.assertEqual(Late().a, None, "Columns assigned after class creation are set up")
+        self.assertTrue(isinstance(Late().q, BoundQuery), "Queries assigned after class creation are bound")
+
+        class Clashing(SimpleModel):
+            table = ['id', 'handle', 'set']
+        model = Clashing(id=1)
+        self.assertTrue(isinstance(Clashing.__dict__['id'], Column))
+        self.assertFalse('handle' in Clashing.__dict__ or 'set' in Clashing.__dict__,
+                         "Columns don't shadow inherited attributes")
+        self.assertTrue(isinstance(Clashing.handle, property))
+        model.set('set', 'x')
+        self.assertEqual(model.as_dict(), {'id': 1, 'handle': None, 'set': 'x'})
+        self.assertEqual(SimpleInstanceModel(id=1).as_dict(), {'id': 1, 'value': None},
+                         "as_dict has every column")
+
     def testInstanceFunctions(self):
         model = SimpleInstanceModel(id=1)
         cur = model.get()
@@ -231,6 +293,14 @@ class ModelTest(dbTest):
         for model in cur:
             self.assertTrue(model.callback_attrib == callback_value, 'Function call callback was executed on row with id={0}'.format(model.id))
 
+        def by_name(row):
+            row['test'].callback_attrib = 'by name'
+            return row
+        f = FunctionTyped('test', [], callback=by_name)
+        self.assertEqual(f().fetchone().callback_attrib, 'by name', "Callbacks get rows with column names")
+        self.assertEqual([model.callback_attrib for model in f()], ['by name'] * 3)
+        self.assertEqual([model.callback_attrib for model in f().fetchmany(2)], ['by name'] * 2)
+
 
     def testNestedModel(self):
         handle = config.handle_factory()
@@ -256,6 +326,228 @@ class ModelTest(dbTest):
         self.assertEqual(model.table, SimpleReturn.table, 'table is determined automatically')
 
 
+class LazyBatchTest(dbTest):
+
+    def testBatchedLazyLoad(self):
+        handle = config.handle_factory()
+        BatchLazyModel.register_composite('public.test_table', handle)
+        models = FunctionTyped("test_partial")().fetchall()
+        with instrument.collect() as collector:
+            values = [model.value for model in models]
+        self.assertEqual(values, ['one', 'two', 'three'], "All instances are loaded")
+        self.assertEqual(len(collector.events), 1, "Siblings are loaded with one call")
+        self.assertEqual(collector.events[0].query_base, 'test_get_many')
+
+    def testLazyloadAll(self):
+        models = [BatchLazyModel(id=i) for i in (1, 3, 4)]
+        missing = BatchLazyModel.lazyload_all(models)
+        self.assertEqual(missing, [models[2]], "Instances without a row are returned")
+        self.assertEqual(models[1].__dict__['value'], 'three', "Explicit list is loaded")
+        self.assertRaises(NotFoundError, getattr, models[2], 'value')
+
+        class Keyless(BatchLazyModel):
+            primary_key = None
+        self.assertRaises(NotImplementedError, Keyless.lazyload_all, [Keyless(id=1)])
+
+class RegisterTest(dbTest):
+
+    def testRegisterComposites(self):
+        handle = config.handle_factory()
+        casters = register_composites([(SimpleLazyLoaderModel, 'public.test_table'), (NestedModel, 'nested')], handle)
+        self.assertEqual([caster.name for caster in casters], ['test_table', 'nested'])
+        model = NestedModel(id=1)
+        self.assertTrue(isinstance(model.others[0], SimpleLazyLoaderModel), "Types are registered")
+        self.assertRaises(psycopg2.ProgrammingError, register_composites, [(SimpleReturn, 'no_such_type')], handle)
+
+    def testRegisterAll(self):
+        class Row(SimpleModel):
+            table = []
+            pg_type = ('public', 'test_table')
+
+        class Nested(Row):
+            pg_type = ('public', 'nested')
+
+        class Extended(Row):
+            def label(self):
+                return '{0}: {1}'.format(self.id, self.value)
+
+        self.assertEqual(register_all([Nested, Extended, Row]), [Row, Nested],
+                         "Base classes are registered first, subclasses without a pg_type of their own not at all")
+        self.assertEqual(Nested.table, ['id', 'value', 'others'])
+        model = FunctionTypedSingle('test_nested', ['id'])(1)
+        self.assertTrue(isinstance(model, Nested))
+        self.assertEqual((model.id, model.value), (1, 'one'), "base_ attributes are merged")
+        self.assertTrue(type(model.others[0]) is Row, "Rows decode into the class declaring the type")
+        self.assertTrue(DynamicModel in register_all([__name__]), "Classes are found in modules")
+
+    def testMetadataCache(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'types.json')
+            register_composites([(DynamicModel, 'public.test_table')], cache_file=path, schema_version=1)
+            self.assertTrue(os.path.exists(path), "Metadata is saved")
+            # the cached metadata is enough: the handle is not used
+            casters = register_composites([(SimpleReturn, 'public.test_table')], object(),
+                                          cache_file=path, schema_version=1)
+            self.assertEqual(casters[0].attnames, ['id', 'value'])
+            self.assertRaises(AttributeError, register_composites, [(SimpleReturn, 'public.test_table')],
+                              object(), cache_file=path, schema_version=2)
+
+            class OtherDatabase(object):
+                dsn = 'dbname=other'
+            self.assertRaises(AttributeError, register_composites, [(SimpleReturn, 'public.test_table')],
+                              OtherDatabase(), cache_file=path, schema_version=1)
+        finally:
+            shutil.rmtree(directory)
+
+
+class CompactModelTest(dbTest):
+
+    def testCompactComposite(self):
+        handle = config.handle_factory()
+        SimpleLazyLoaderModel.register_composite('public.test_table', handle, compact=True)
+        model = FunctionTypedSingle("test_get", ['id'], handle=handle)(id=1)
+        compact = SimpleLazyLoaderModel.compact_class()
+        self.assertTrue(type(model) is compact, "Rows are decoded into the compact class")
+        self.assertTrue(isinstance(model, SimpleLazyLoaderModel))
+        self.assertTrue(compact is SimpleLazyLoaderModel.compact_class(), "Compact class is reused")
+        self.assertEqual((model.id, model.value), (1, 'one'))
+        model.set('value', 'changed')
+        self.assertEqual(model.value, 'changed')
+        self.assertFalse(hasattr(model, 'callback_attrib'))
+
+    def testCompactLazyLoad(self):
+        handle = config.handle_factory()
+        SimpleLazyLoaderModel.register_composite('public.test_table', handle, compact=True)
+        models = FunctionTyped("test_partial", handle=handle)().fetchall()
+        self.assertEqual([model.value for model in models], ['one', 'two', 'three'],
+                         "Compact instances are lazy loaded")
+        compact = SimpleLazyLoaderModel.compact_class()
+        model = compact(id=1, value='one')
+        self.assertEqual(compact.slot_map['value'].__get__(model, compact), 'one',
+                         "Columns are stored in slots")
+
+    def testCompactClashingColumns(self):
+        class Clashing(SimpleModel):
+            table = ['id', 'handle', 'set']
+        compact = Clashing.compact_class()
+        self.assertFalse('handle' in compact.slot_map or 'set' in compact.slot_map,
+                         "Columns don't shadow inherited attributes")
+        model = compact(id=1)
+        self.assertTrue(isinstance(compact.handle, property))
+        model.set('set', 'x')
+        self.assertEqual(model.as_dict(), {'id': 1, 'handle': None, 'set': 'x'})
+
+
+class LazyGroupTest(dbTest):
+
+    def testGroupLoad(self):
+        model = GroupModel(id=1)
+        with instrument.collect() as collector:
+            self.assertEqual(model.value, 'one')
+            self.assertEqual(model.value, 'one')
+        self.assertEqual(len(collector.events), 1, "Group is loaded once")
+        self.assertTrue(collector.events[0].sql.startswith('SELECT value FROM'), "Only the group is loaded")
+        self.assertFalse(model._loaded, "Columns in no group are left to load")
+
+    def testBatchedGroupLoad(self):
+        handle = config.handle_factory()
+        GroupBatchModel.register_composite('public.test_table', handle)
+        models = FunctionTyped("test_partial")().fetchall()
+        with instrument.collect() as collector:
+            values = [model.value for model in models]
+        self.assertEqual(values, ['one', 'two', 'three'])
+        self.assertEqual(len(collector.events), 1, "Group of all siblings is loaded with one call")
+        self.assertTrue(collector.events[0].sql.startswith('SELECT id,value FROM'))
+
+    def testDirectGroupLoad(self):
+        handle = config.handle_factory()
+        GroupDirectModel.register_composite('public.test_table', handle)
+        model = GroupDirectModel(id=1)
+        with instrument.collect() as collector:
+            self.assertEqual(model.value, 'one')
+        self.assertEqual(len(collector.events), 1)
+        self.assertTrue(model._loaded, "A direct loader loads all the columns")
+
+
+class ChangeTrackingTest(dbTest):
+
+    def testSave(self):
+        model = SaveModel(1)
+        self.assertEqual(model.changes(), {}, "Loaded instance is unchanged")
+        with instrument.collect() as collector:
+            model.save()
+        self.assertEqual(len(collector.events), 0, "Unchanged instance is not saved")
+        model.value = 'changed'
+        self.assertEqual(model.changes(), {'value': 'changed'})
+        with instrument.collect() as collector:
+            model.save()
+        self.assertEqual([event.query_base for event in collector.events], ['update_partial'],
+                         "Changes are saved with __save_partial__")
+        self.assertEqual(model.changes(), {})
+        self.assertEqual(SaveModel(1).value, 'changed')
+
+    def testSaveUntracked(self):
+        model = SaveModel(id=2, value='set')
+        self.assertEqual(model.changes(), None, "Instance made from arguments is not tracked")
+        model.set('value', 'saved')
+        with instrument.collect() as collector:
+            model.save()
+        self.assertEqual([event.query_base for event in collector.events], ['update_row'],
+                         "Untracked instance is saved with __save__")
+        self.assertEqual(model.changes(), {}, "Changes are tracked once saved")
+        self.assertEqual(SaveModel(2).value, 'saved')
+
+
+class IdentityMapTest(dbTest):
+
+    def testConstruct(self):
+        from simpycity.handle import Handle
+        handle = Handle()
+        handle.enable_identity_map()
+        with instrument.collect() as collector:
+            first = IdentityModel(id=1, handle=handle)
+            again = IdentityModel(1, handle=handle)
+        self.assertTrue(first is again, "Loaded instance is returned")
+        self.assertEqual(len(collector.events), 1, "Instance is loaded once")
+        self.assertEqual(again.value, 'one')
+        handle.rollback()
+        self.assertFalse(IdentityModel(id=1, handle=handle) is first, "Map is emptied when the transaction ends")
+        handle.close()
+
+    def testComposite(self):
+        from simpycity.handle import Handle
+        handle = Handle()
+        IdentityReturn.register_composite('public.test_table', handle)
+        f = FunctionTyped("test", handle=handle)
+        self.assertFalse(f().fetchone() is f().fetchone(), "No identity map by default")
+        handle.enable_identity_map()
+        first = list(f())
+        self.assertEqual([model.id for model in first], [1, 2, 3])
+        self.assertTrue(all(a is b for a, b in zip(first, f())), "Rows already loaded are the same instances")
+        self.assertTrue(IdentityReturn(id=2, handle=handle) is first[1], "Constructor finds composite values")
+        unsaved = IdentityReturn(id=4, value='four', handle=handle)
+        self.assertFalse(IdentityReturn(id=4, handle=handle) is unsaved, "Instances made from arguments aren't mapped")
+        self.assertFalse(IdentityReturn(id=2, value='x', handle=handle) is first[1],
+                         "Only constructors given just the primary key are looked up")
+        handle.close()
+
+    def testTypedLazyLoad(self):
+        from simpycity.handle import Handle
+        handle = Handle()
+        IdentityLazyModel.register_composite('public.test_table', handle)
+        handle.enable_identity_map()
+        try:
+            models = FunctionTyped("test_partial", handle=handle)().fetchall()
+            models[0].init_handle = handle
+            self.assertEqual(models[0].value, 'one', "Mapped instance is filled by its typed lazy load")
+            self.assertTrue(IdentityLazyModel(id=2, handle=handle) is models[1])
+            IdentityLazyModel.lazyload_all(models[1:], handle=handle)
+            self.assertEqual([model.value for model in models], ['one', 'two', 'three'],
+                             "Mapped instances are filled by a typed batch load")
+        finally:
+            handle.close()
+
 class FunctionTest(dbTest):
 
     def testCreateFunction(self):
@@ -303,6 +595,71 @@ class FunctionTest(dbTest):
             except Exception as e:
                 self.fail("Failed with exception: %s" %e)
 
+    def testArgumentBinding(self):
+        f = Function("update_row",['id','new_value'])
+        self.assertEqual(f.__bind__((1,), {'new_value': 'x'}), [1, 'x'], "Positional and keyword arguments are combined")
+        self.assertEqual(f.__bind__((), {'new_value': 'x'}), ['', 'x'], "Missing keyword arguments default to ''")
+        self.assertRaises(Exception, f.__bind__, (1,), {})
+        self.assertRaises(Exception, f.__bind__, (1, 'x', 2), {})
+        self.assertRaises(Exception, f.__bind__, (), {'bogus': 1})
+        f.args = ['new_value', 'id']
+        self.assertEqual(f.__bind__((), {'id': 1}), ['', 1], "Reassigning args recompiles the binder")
+
+    def testMany(self):
+        f = FunctionSingle("test_get",['id'])
+        rows = f.many([(3,), {'id': 1}, (2,)])
+        self.assertEqual([_['value'] for _ in rows], ['three', 'one', 'two'], "Batch results are in input order")
+        f = Function("test",['id'])
+        rows = f.many([(2,), (1,)], page_size=1, options={'columns': ['id']})
+        self.assertEqual([[_['id'] for _ in r] for r in rows], [[2], [1]], "Each call gets its own rows")
+
+    def testManyTyped(self):
+        handle = config.handle_factory()
+        SimpleReturn.register_composite('public.test_table', handle)
+        f = FunctionTypedSingle("test_get",['id'])
+        models = f.many([(2,), (1,)])
+        self.assertTrue(isinstance(models[0], SimpleReturn), "Typed batch returns model instances")
+        self.assertEqual([_.id for _ in models], [2, 1], "Typed batch results are in input order")
+
+    def testManyNoFetch(self):
+        f = Function("update_row",['id','new_value'])
+        self.assertEqual(f.many([(1, 'uno'), (2, 'dos')], fetch=False), None, "Unfetched batch returns nothing")
+        self.assertEqual(FunctionSingle("get_value",['id'],direct=True)(2)[0], 'dos', "Batched calls are executed")
+
+    def testManyBraces(self):
+        f = Raw("SELECT %s = ANY('{1,2}'::int[]) AS found", ['n'])
+        self.assertEqual([rows[0]['found'] for rows in f.many([[1], [3]])], [True, False],
+                         "Braces in the query are kept")
+
+    def testCompiledQueryCache(self):
+        f = Function("test",['id'])
+        f(1)
+        f(2)
+        f(1,options=dict(columns=['id']))
+        info = f.query_cache_info()
+        self.assertEqual(info['misses'], 2, "Each column list is compiled once, got %s" % info['misses'])
+        self.assertEqual(info['hits'], 1, "Repeated call reuses compiled sql, got %s" % info['hits'])
+        self.assertEqual(info['size'], 2, "Both compiled queries are cached")
+        f.args = []
+        self.assertEqual(f.sql()[0], "SELECT * FROM test()", "Assigning args drops the compiled sql")
+
+        class Limited(Function):
+            def form_query(self, columns, options={}):
+                return super(Limited, self).form_query(columns, options) + " LIMIT %d" % options['limit']
+        g = Limited("test")
+        self.assertTrue(g.sql(options={'limit': 1})[0].endswith("LIMIT 1"))
+        self.assertTrue(g.sql(options={'limit': 2})[0].endswith("LIMIT 2"),
+                        "Overriding form_query alone disables the compiled sql cache")
+
+    def testPreparedFunction(self):
+        handle = config.handle_factory()
+        f = FunctionSingle("test_get",['id'], prepared=True)
+        row = f(1, options={'handle': handle})
+        self.assertEqual(row['value'], 'one', 'Prepared function returns the row')
+        row = f(2, options={'handle': handle})
+        self.assertEqual(row['value'], 'two', 'Prepared function is reused with new arguments')
+        self.assertEqual(len(handle.__statements__), 1, 'Function is prepared once per connection')
+
 class QueryTest(dbTest):
 
     def testBareQuery(self):
@@ -329,6 +686,39 @@ class QueryTest(dbTest):
         self.assertEqual(row['id'],1,'Return row not 1, got %s' % row['id'])
         self.assertEqual(row['value'],'one', 'Return row not "one", got %s' % row['value'])
 
+    def testPreparedQuery(self):
+        q = Query("test_table",['id'], prepared=True)
+        cur = q(3)
+        self.assertEqual(cur.rowcount,1,"Prepared query returns a single entry")
+        self.assertEqual(cur.fetchone()['value'],'three','Prepared query returns the row')
+
+    def testStreamQuery(self):
+        q = Query("test_table", callback=lambda row: row['value'])
+        cur = q(options={'itersize': 2})
+        self.assertTrue(cur.name is not None, "Streaming query uses a named cursor")
+        self.assertEqual(sorted(cur), ['one', 'three', 'two'], "Streamed rows pass through the callback")
+
+    def testStreamTyped(self):
+        handle = config.handle_factory()
+        SimpleReturn.register_composite('public.test_table', handle)
+        q = QueryTyped("test_table")
+        models = list(q(options={'stream': True, 'handle': handle}))
+        self.assertEqual(len(models), 3, "Streamed typed query returns every row")
+        self.assertTrue(isinstance(models[0], SimpleReturn), "Streamed typed rows are model instances")
+
+    def testRowTypes(self):
+        q = QuerySingle("test_table",['id'], row_type='tuple')
+        self.assertEqual(q(1), (1, 'one'), "Tuple row type returns plain tuples")
+        row = q(1, options={'row_type': 'namedtuple'})
+        self.assertEqual(row.value, 'one', "Namedtuple row type exposes columns as attributes")
+        self.assertTrue(type(q(2, options={'row_type': 'namedtuple'})) is type(row), "Namedtuple class is cached per column list")
+        self.assertEqual(q(1, options={'row_type': dict}), {'id': 1, 'value': 'one'}, "Dict row type returns dicts")
+        rows = Query("test_table",['id'], row_type='namedtuple').many([(2,), (3,)])
+        self.assertEqual([r[0].value for r in rows], ['two', 'three'], "Batches honour the row type")
+        cur = config.handle_factory().cursor(row_type='tuple')
+        cur.execute("SELECT 1, 2")
+        self.assertEqual(cur.fetchone(), (1, 2), "Handle.cursor accepts a row type")
+
     def testPartialReturnSet(self):
         q = Query("test_table")
         try:
@@ -359,6 +749,376 @@ class QueryTest(dbTest):
             except Exception as e:
                 self.fail("Failed with exception: %s" %e)
 
+class HandleTest(dbTest):
+
+    def testReconnectClosed(self):
+        from simpycity.handle import Handle
+        handle = Handle(isolation_level=0)
+        pid = handle.backend_pid
+        handle.conn.close()
+        cur = handle.cursor()
+        cur.execute("SELECT 1")
+        self.assertNotEqual(handle.backend_pid, pid, "Closed connection is replaced on next cursor")
+        self.assertTrue(handle.conn.autocommit, "Isolation level survives the reconnect")
+        handle.close()
+
+    def testHealthCheck(self):
+        from simpycity.handle import Handle
+        handle = Handle()
+        handle.health_check_interval = 0
+        pid = handle.backend_pid
+        killer = config.handle_factory()
+        killer.execute("SELECT pg_terminate_backend(%s)", [pid])
+        killer.commit()
+        handle.next_health_check = 0
+        cur = handle.cursor()
+        cur.execute("SELECT 1")
+        self.assertNotEqual(handle.backend_pid, pid, "Periodic health check replaces a dead connection")
+        handle.close()
+
+    def __kill__(self, handle):
+        killer = config.handle_factory()
+        killer.execute("SELECT pg_terminate_backend(%s)", [handle.backend_pid])
+        killer.commit()
+
+    def testRetryLostConnection(self):
+        from simpycity.handle import Handle, RetryPolicy
+        policy = RetryPolicy(backoff=0)
+        handle = Handle()
+        pid = handle.backend_pid
+        self.__kill__(handle)
+        rs = Function("test", retry=policy)(options={'handle': handle})
+        self.assertEqual(rs.rowcount, 3, "Query is retried on a new connection")
+        self.assertNotEqual(handle.backend_pid, pid, "Handle reconnected")
+        self.assertEqual(policy.stats()['recovered'], 1, "Recovery is counted")
+
+        handle.execute("SELECT 1")
+        self.__kill__(handle)
+        self.assertRaises(psycopg2.OperationalError, Function("test", retry=policy), options={'handle': handle})
+        self.assertEqual(policy.stats()['gave_up'], 1, "No retry inside an open transaction")
+        handle.close()
+
+    def testRetryAutocommit(self):
+        from simpycity.handle import Handle, RetryPolicy
+        policy = RetryPolicy(backoff=0)
+        handle = Handle(isolation_level=0)
+        self.__kill__(handle)
+        self.assertRaises(psycopg2.OperationalError, Function("test", retry=policy), options={'handle': handle})
+        handle.execute("SELECT 1")
+        self.__kill__(handle)
+        rs = Query("test_table", retry=policy)(options={'handle': handle})
+        self.assertEqual(rs.rowcount, 3, "Idempotent query is retried in autocommit mode")
+        self.assertEqual(policy.stats(), {'retries': 1, 'recovered': 1, 'gave_up': 1})
+        handle.close()
+
+class PipelineTest(dbTest):
+
+    def testPipeline(self):
+        handle = config.handle_factory()
+        SimpleReturn.register_composite('public.test_table', handle)
+        with handle.pipeline():
+            rows = Function("test")()
+            row = QuerySingle("test_table", ['id'])(2)
+            model = FunctionTypedSingle("test_get", ['id'])(3)
+            constant = FunctionSingle("test_constant", direct=True)()
+            missing = QuerySingle("test_table", ['id'])(99)
+            self.assertFalse(rows.done(), "Calls are queued until the block ends")
+        self.assertEqual([r['id'] for r in rows.result()], [1, 2, 3], "Rows keep their order")
+        self.assertEqual(row.result()['value'], 'two', "Single call returns its row")
+        self.assertEqual(model.result().value, 'three', "Typed call returns the model")
+        self.assertEqual(constant.result()['test_constant'], 1, "Direct call returns its value")
+        self.assertRaises(Exception, missing.result)
+
+    def testPipelineTypes(self):
+        handle = config.handle_factory()
+        SimpleReturn.register_composite('public.test_table', handle)
+        query = Raw("""SELECT 1.10::numeric AS amount, '2020-01-02'::date AS day, '\\x00ff'::bytea AS data,
+            test_get(1) AS model, ARRAY[1, NULL] AS ints, NULL::text AS nothing""")
+        direct = query().fetchone()
+        with handle.pipeline():
+            pipelined = query()
+            again = query()
+        row = pipelined.result().fetchone()
+        self.assertEqual(list(row.keys()), list(direct.keys()), "Columns keep their names and order")
+        for name in ('amount', 'day', 'ints', 'nothing'):
+            self.assertEqual(row[name], direct[name], "%s has the same value and type in a pipeline" % name)
+            self.assertEqual(type(row[name]), type(direct[name]))
+        self.assertEqual(bytes(row['data']), bytes(direct['data']))
+        self.assertTrue(isinstance(row['model'], SimpleReturn), "Composite columns are decoded")
+        self.assertEqual(again.result().fetchone()['amount'], direct['amount'])
+
+    def testFlushAndDiscard(self):
+        handle = config.handle_factory()
+        with handle.pipeline():
+            first = FunctionSingle("get_value", ['id'], direct=True)(1)
+            self.assertEqual(first.result()['get_value'], 'one', "result() flushes the queued calls")
+            self.assertTrue(first.done())
+        try:
+            with handle.pipeline():
+                pending = Function("test")()
+                raise ValueError()
+        except ValueError:
+            pass
+        self.assertRaises(ProgrammingError, pending.result)
+        self.assertEqual(Function("test")().rowcount, 3, "Handle runs calls directly after the block")
+
+class InstrumentTest(dbTest):
+
+    def testCollect(self):
+        with instrument.collect() as collector:
+            rows = Function("test")().fetchall()
+            row = QuerySingle("test_table", ['id'])(2)
+            self.assertRaises(psycopg2.ProgrammingError, Raw("SELECT no_such_column FROM test_table"))
+        config.handle_factory().rollback()
+        Function("test")()
+        self.assertEqual(len(collector.events), 3, "Only queries inside the block are collected")
+        first, second, failed = collector.events
+        self.assertEqual((first.query_base, first.rowcount, first.rows), ("test", 3, 3))
+        self.assertEqual(second.rows, 1, "Rows fetched by QuerySingle are counted")
+        self.assertTrue(isinstance(failed.error, psycopg2.ProgrammingError), "Errors are recorded")
+        self.assertTrue(first.execute_time > 0 and first.fetch_time > 0, "Execute and fetch are timed")
+
+    def testHistogram(self):
+        histogram = instrument.Histogram()
+        instrument.register(histogram)
+        try:
+            f = FunctionTyped("test")
+            for i in range(3):
+                list(f())
+        finally:
+            instrument.unregister(histogram)
+        f()
+        stats = histogram.stats()['test']
+        self.assertEqual(stats['calls'], 3, "Calls are counted until the hook is unregistered")
+        self.assertEqual(stats['rows'], 9, "Iterated rows are counted")
+        self.assertEqual(sum(stats['buckets']), 3, "Each call lands in a latency bucket")
+        self.assertEqual(histogram.slowest(1)[0][0], 'test')
+
+class CacheTest(dbTest):
+
+    def testCachedCalls(self):
+        cache = ResultCache(ttl=None, maxsize=2)
+        get = QuerySingle("test_table", ['id'], cache=cache)
+        self.assertEqual(get(1)['value'], 'one')
+        FunctionSingle("update_row", ['id', 'value'])(1, 'changed')
+        self.assertEqual(get(1)['value'], 'one', "Cached row is returned")
+        self.assertEqual(get(1, options={'cache': False})['value'], 'changed', "Cache can be bypassed")
+        self.assertEqual(Function("test", cache=cache)().rowcount, 3, "Cached cursor has a rowcount")
+        get(2)
+        self.assertEqual(cache.info()['evictions'], 1, "Least recently used entry is evicted")
+        cache.invalidate(get)
+        self.assertEqual(get(1)['value'], 'changed', "Invalidated query runs again")
+        self.assertEqual((cache.info()['hits'], cache.info()['size']), (1, 2))
+
+    def testExpiry(self):
+        cache = ResultCache(ttl=0)
+        get = QuerySingle("test_table", ['id'], cache=cache)
+        get(1)
+        get(1)
+        self.assertEqual(cache.info()['hits'], 0, "Expired entries are not used")
+
+    def testDatabases(self):
+        from simpycity.handle import Handle
+        cache = ResultCache(ttl=None)
+        get = QuerySingle("test_table", ['id'], cache=cache)
+        first, second = Handle(), Handle(dsn='dbname=' + os.environ.get('PGDATABASE', 'postgres'))
+        get(1, options={'handle': first})
+        get(1, options={'handle': second})
+        self.assertEqual(cache.info()['hits'], 0, "Entries are kept per database")
+        get(1, options={'handle': second})
+        self.assertEqual(cache.info()['hits'], 1)
+        first.close()
+        second.close()
+
+    def testNotify(self):
+        from simpycity.handle import Handle
+        cache = ResultCache(ttl=None)
+        listener = Handle()
+        cache.listen(listener)
+        get = QuerySingle("test_table", ['id'], cache=cache)
+        get(1)
+        sender = Handle()
+        cache.notify(sender, get)
+        sender.commit()
+        time.sleep(0.1)
+        get(1)
+        self.assertEqual(cache.info()['hits'], 0, "Notification invalidates the query")
+        get(1)
+        self.assertEqual(cache.info()['hits'], 1)
+        sender.close()
+        listener.close()
+
+class CopyTest(dbTest):
+
+    def testCopyOut(self):
+        handle = config.handle_factory()
+        out = io.StringIO()
+        handle.copy_out(Query("test_table",['id']), out, format='csv', args=(2,))
+        self.assertEqual(out.getvalue(), '2,two\n', "Query result is copied as csv")
+
+    def testCopyIn(self):
+        handle = config.handle_factory()
+        count = handle.copy_in('test_table', [(4, 'four\tand a tab'), (5, None)])
+        self.assertEqual(count, 2, "Both rows are copied")
+        row = QuerySingle("test_table",['id'])(4)
+        self.assertEqual(row['value'], 'four\tand a tab', "Special characters survive the copy")
+        count = handle.copy_in('test_table', io.StringIO('value,id\nsix,6\n'), format='csv', header=True, columns=['value', 'id'])
+        self.assertEqual(count, 1, "Csv file is copied")
+
+    def testCopyInTypes(self):
+        import datetime, decimal, psycopg2.tz
+        handle = config.handle_factory()
+        handle.execute("""CREATE TEMP TABLE copy_types (ints int[], texts text[], data bytea,
+            doc jsonb, at timestamptz, amount numeric, flag boolean)""")
+        at = datetime.datetime(2020, 1, 2, 3, 4, 5, tzinfo=psycopg2.tz.FixedOffsetTimezone(60))
+        row = ([[1, None], [3, 4]], ['a "b"', 'c,d\\e', None], bytes(b'\x00\\\xff'), {'key': [1, 'two']},
+               at, decimal.Decimal('1.10'), False)
+        handle.copy_in('copy_types', [row])
+        copied = Raw("SELECT * FROM copy_types", handle=handle)().fetchone()
+        self.assertEqual(list(copied[:2]), list(row[:2]), "Arrays are copied")
+        self.assertEqual(bytes(copied[2]), row[2], "Bytes are copied as bytea")
+        self.assertEqual(copied[3], row[3], "Dicts are copied as json")
+        self.assertEqual(list(copied[4:]), list(row[4:]))
+        from simpycity.handle import format_copy_row, format_copy_value
+        self.assertRaises(TypeError, format_copy_row, [set([1])])
+        self.assertEqual(format_copy_value(native_str('text')), 'text', "Native strings are text")
+        self.assertEqual(format_copy_value(bytes(b'ab')), '\\x6162', "Bytes are bytea")
+
+    def testCopyRows(self):
+        handle = config.handle_factory()
+        rows = list(handle.copy_rows(Query("test_table"), queue_size=1))
+        self.assertEqual(sorted(rows), [('1', 'one'), ('2', 'two'), ('3', 'three')], "Copied rows are parsed")
+        rows = handle.copy_rows("SELECT NULL, 'a\\b'")
+        self.assertEqual(next(rows), (None, 'a\\b'), "NULL and escapes are decoded")
+        rows.close()
+        self.assertEqual(Function("test")().rowcount, 3, "Handle is usable after closing the generator early")
+
+class PoolTest(dbTest):
+
+    def testCheckoutCheckin(self):
+        pool = HandlePool(minconn=1, maxconn=2)
+        first = pool.handle_factory()
+        self.assertEqual(pool.idle, 0, "Idle handle was checked out")
+        first.close()
+        self.assertEqual(pool.idle, 1, "Closing a pooled handle returns it to the pool")
+        first.close()
+        self.assertEqual(pool.idle, 1, "Closing it again does nothing")
+        self.assertTrue(pool.checkout() is first, "Idle handle is reused")
+        pool.closeall()
+
+    def testCheckOnCheckout(self):
+        pool = HandlePool(minconn=1, maxconn=2, check_on_checkout=True)
+        dead = pool.checkout()
+        dead.close()
+        dead.conn.close()
+        unlocked = []
+
+        def check(handle):
+            # another thread can take the lock while the handle is checked
+            waiter = threading.Thread(target=lambda: pool._cond.acquire() and pool._cond.release())
+            waiter.start()
+            waiter.join(1)
+            unlocked.append(not waiter.is_alive())
+            return HandlePool._healthy(pool, handle)
+        pool._healthy = check
+        handle = pool.checkout()
+        self.assertFalse(handle is dead, "Dead handle is replaced")
+        self.assertEqual(unlocked, [True], "Health check runs without the lock")
+        self.assertEqual(pool.size, 1)
+        handle.close()
+        pool.closeall()
+
+    def testExhausted(self):
+        pool = HandlePool(minconn=0, maxconn=1, timeout=0.1)
+        pool.checkout()
+        self.assertRaises(PoolError, pool.checkout)
+        pool.closeall()
+
+    def testConstructClose(self):
+        pool = HandlePool(minconn=0, maxconn=1)
+
+        class o(Construct):
+            r = Raw("SELECT * FROM test_table")
+
+        instance = o(handle=pool.checkout())
+        instance.handle.begin()
+        instance.r(options={'handle': instance.handle})
+        instance.close()
+        self.assertEqual(pool.idle, 1, "Construct.close returns the handle to the pool")
+        self.assertEqual(pool.size, 1, "Handle is kept open")
+        pool.closeall()
+
+    def testHandlelessCalls(self):
+        pool = HandlePool(minconn=0, maxconn=2, timeout=0.1)
+        factory = config.handle_factory
+        config.handle_factory = pool.handle_factory
+        try:
+            for i in range(5):
+                self.assertEqual(Raw("SELECT %s AS n", ['n'])(i).fetchone()['n'], i)
+            query = FunctionSingle("test_get", ['id'])
+            self.assertEqual(query(1)['value'], 'one')
+            self.assertEqual(query(2)['value'], 'two', "Each call checks a handle out")
+            results = Raw("SELECT %s AS n", ['n']).many([[1], [2], [3]])
+            self.assertEqual([[row['n'] for row in rows] for rows in results], [[1], [2], [3]])
+            self.assertEqual(pool.idle, pool.size, "Handles are returned to the pool")
+        finally:
+            config.handle_factory = factory
+            pool.closeall()
+
+@unittest.skipIf(sys.version_info < (3, 5), "asyncio support requires Python 3.5")
+class AsyncTest(dbTest):
+
+    def setUp(self):
+        super(AsyncTest, self).setUp()
+        from simpycity.aio import AsyncHandle
+        self.handle = AsyncHandle(maxconn=2)
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def tearDown(self):
+        self.handle.close()
+        self.loop.close()
+        asyncio.set_event_loop(None)
+        super(AsyncTest, self).tearDown()
+
+    def run_async(self, awaitable):
+        return self.loop.run_until_complete(awaitable)
+
+    def testAwaitCalls(self):
+        opts = {'handle': self.handle}
+        cur = self.run_async(Function("test")(options=opts))
+        self.assertEqual(cur.rowcount, 3, "Awaited Function returns its cursor")
+        row = self.run_async(QuerySingle("test_table", ['id'])(2, options=opts))
+        self.assertEqual(row['value'], 'two', "Awaited QuerySingle returns its row")
+        SimpleReturn.register_composite('public.test_table', config.handle_factory())
+        item = self.run_async(FunctionTypedSingle("test_get", ['id'])(3, options=opts))
+        self.assertEqual(item.value, 'three', "Awaited typed call returns the model")
+
+    def testConcurrentCalls(self):
+        f = Raw("SELECT pg_sleep(0.2), %s AS n", ['n'], handle=self.handle)
+        start = time.time()
+        cursors = self.run_async(asyncio.gather(*[f(n) for n in range(4)]))
+        self.assertTrue(time.time() - start < 0.7, "Calls run concurrently on the pooled connections")
+        self.assertEqual([cur.fetchone()['n'] for cur in cursors], [0, 1, 2, 3])
+        self.assertEqual(self.handle.size, 2, "Connections are capped at maxconn")
+
+    def testTransaction(self):
+        update = FunctionSingle("update_row", ['id', 'value'])
+
+        def change(value, fail):
+            # async with, spelled out to keep this module valid Python 2
+            tx = self.run_async(self.handle.transaction().__aenter__())
+            self.run_async(update(1, value, options={'handle': tx}))
+            error = ValueError() if fail else None
+            self.run_async(tx.__aexit__(type(error) if fail else None, error, None))
+
+        get = QuerySingle("test_table", ['id'], handle=self.handle)
+        change('rolled back', True)
+        self.assertEqual(self.run_async(get(1))['value'], 'one', "Failed transaction is rolled back")
+        change('committed', False)
+        row = self.run_async(get(1))
+        self.assertEqual(row['value'], 'committed', "Transaction commits only on success")
+
 class RawTest(dbTest):
 
     def testRunQuery(self):
@@ -410,6 +1170,39 @@ class NestedModel(SimpleLazyLoaderModel):
     table = SimpleLazyLoaderModel.table + ['others']
     __lazyload__ = FunctionSingle("test_nested",['id'])
 
+class IdentityModel(SimpleLoaderModel):
+    primary_key = 'id'
+
+class IdentityReturn(SimpleReturn):
+    primary_key = ['id']
+
+class IdentityLazyModel(SimpleReturn):
+    primary_key = 'id'
+    loaded_indicator = 'value'
+    __lazyload__ = FunctionTypedSingle("test_get", ['id'])
+    __lazyload_many__ = FunctionTyped("test_get_many", ['ids'])
+
+class BatchLazyModel(SimpleReturn):
+    primary_key = 'id'
+    loaded_indicator = 'value'
+    __lazyload_many__ = Function("test_get_many", ['ids'])
+
+class SaveModel(SimpleLoaderModel):
+    loaded_indicator = 'value'
+    __save__ = Function("update_row", ['id', 'value'])
+    __save_partial__ = Function("update_partial", ['id', 'changes'])
+
+class GroupModel(SimpleReturn):
+    __lazyload__ = FunctionSingle("test_get", ['id'])
+    lazy_groups = {'text': ['value']}
+
+class GroupBatchModel(BatchLazyModel):
+    lazy_groups = {'text': ['value']}
+
+class GroupDirectModel(SimpleReturn):
+    __lazyload__ = FunctionSingle("test_get", ['id'], direct=True)
+    lazy_groups = {'text': ['value']}
+
 class DynamicModel(SimpleModel):
     table = []
     pg_type = ('public','test_table')